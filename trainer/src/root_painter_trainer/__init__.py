@@ -29,9 +29,16 @@ def start():
             "location of directory where data is synced between the client and server"
         ),
     )
+    parser.add_argument(
+        "--device",
+        help=(
+            "device to train and segment with i.e cuda, cuda:1, mps or cpu. "
+            "Defaults to cuda if available, then mps, then cpu"
+        ),
+    )
     args, _ = parser.parse_known_args()
     if args.syncdir:
-        trainer = Trainer(sync_dir=args.syncdir)
+        trainer = Trainer(sync_dir=args.syncdir, device=args.device)
     else:
-        trainer = Trainer()
+        trainer = Trainer(device=args.device)
     trainer.main_loop()
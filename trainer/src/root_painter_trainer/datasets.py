@@ -22,88 +22,236 @@ import math
 import numpy as np
 import torch
 from torch.utils.data import Dataset
-from torchvision.transforms import ColorJitter
-from PIL import Image
-from skimage import img_as_float32
-from skimage.exposure import rescale_intensity
 
-from root_painter_trainer.im_utils import load_train_image_and_annot
 from root_painter_trainer.file_utils import ls
-from root_painter_trainer import im_utils
+from root_painter_trainer.image_cache import TrainImageCache, sample_tile_offset
 from root_painter_trainer import elastic
 
 
-def elastic_transform(photo, annot):
-    def_map = elastic.get_elastic_map(
-        photo.shape, scale=random.random(), intensity=0.4 + (0.6 * random.random())
-    )
+def elastic_transform(photo, annot, map_pool=None):
+    if map_pool is None:
+        def_map = elastic.get_random_elastic_map(photo.shape)
+    else:
+        def_map = map_pool.get()
     photo = elastic.transform_image(photo, def_map)
     annot = elastic.transform_image(annot, def_map, channels=2)
     annot = np.round(annot).astype(np.int64)
     return photo, annot
 
 
-def guassian_noise_transform(photo, annot):
-    sigma = np.abs(np.random.normal(0, scale=0.09))
-    photo = im_utils.add_gaussian_noise(photo, sigma)
-    return photo, annot
+def normalize_in_place(photo):
+    """im_utils.normalize_tile without the copy"""
+    low, high = photo.min(), photo.max()
+    if low < high:
+        photo -= low
+        photo /= high - low
+    return photo
 
 
-def salt_pepper_transform(photo, annot):
-    salt_intensity = np.abs(np.random.normal(0.0, 0.008))
-    photo = im_utils.add_salt_pepper(photo, salt_intensity)
-    return photo, annot
+def adjust_brightness(photo, factor):
+    photo *= factor
+    np.clip(photo, 0, 1, out=photo)
+
+
+def adjust_contrast(photo, factor):
+    mean = np.mean(photo @ grey_weights)
+    photo *= factor
+    photo += (1 - factor) * mean
+    np.clip(photo, 0, 1, out=photo)
+
+
+def adjust_saturation(photo, factor):
+    grey = photo @ grey_weights
+    photo *= factor
+    photo += ((1 - factor) * grey)[:, :, np.newaxis]
+    np.clip(photo, 0, 1, out=photo)
+
+
+def adjust_hue(photo, factor):
+    """rotate the hue by factor (-0.5 to 0.5) of a full turn. Done as a
+    rotation of the chroma (I and Q) axes in YIQ space which, unlike
+    converting to HSV and back, is a single matrix multiply."""
+    angle = factor * 2 * math.pi
+    cos, sin = math.cos(angle), math.sin(angle)
+    rotate = np.array([[1, 0, 0], [0, cos, -sin], [0, sin, cos]], dtype=np.float32)
+    hue_matrix = np.linalg.inv(rgb_to_yiq) @ rotate @ rgb_to_yiq
+    photo[:] = photo @ hue_matrix.T.astype(np.float32)
+    np.clip(photo, 0, 1, out=photo)
+
+
+# same as used by torchvision to convert RGB to greyscale
+grey_weights = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+rgb_to_yiq = np.array(
+    [[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]]
+)
 
 
 class UNetTransformer:
     """Data Augmentation"""
 
-    def __init__(self):
-        self.color_jit = ColorJitter(
-            brightness=0.3, contrast=0.3, saturation=0.2, hue=0.001
-        )
+    def __init__(self, elastic=True, elastic_pool_size=0):
+        # elastic is False when the elastic deformation is done later,
+        # on the batch (see elastic.transform_batch).
+        self.elastic = elastic
+        # if elastic_pool_size then elastic maps are taken from a pool
+        # which is refreshed in the background (see elastic.ElasticMapPool)
+        self.elastic_pool_size = elastic_pool_size
+        self.map_pools = {}
+        # for the noise and salt and pepper. Seeded for each data loader
+        # worker by seed_worker.
+        self.rng = np.random.default_rng()
+        self.noise = None  # buffer reused for the gaussian noise
+        # The same ranges as were used with torchvision ColorJitter
+        self.brightness = 0.3
+        self.contrast = 0.3
+        self.saturation = 0.2
+        self.hue = 0.001
+
+    def seed(self, seed):
+        self.rng = np.random.default_rng(seed)
 
     def transform(self, photo, annot):
-        transforms = random.sample(
-            [
-                elastic_transform,
-                guassian_noise_transform,
-                salt_pepper_transform,
-                self.color_jit_transform,
-            ],
-            4,
-        )
+        """
+        Augment a photo tile (uint8 or float) and its annotation.
+
+        The photo is copied once to a float32 buffer that is normalized and
+        then changed in place by each augmentation. The flip is done
+        along with the final normalization, which also moves the channels
+        first, so the photo is returned as (channels, height, width),
+        ready for torch.
+        """
+        buffer = np.empty(photo.shape, dtype=np.float32)
+        if photo.dtype == np.uint8:
+            # as img_as_float32
+            np.multiply(photo, np.float32(1 / 255), out=buffer)
+        else:
+            buffer[:] = photo
+        photo = normalize_in_place(buffer)
+
+        transforms = [
+            self.guassian_noise_transform,
+            self.salt_pepper_transform,
+            self.color_jit_in_place,
+        ]
+        if self.elastic:
+            transforms.append(self.elastic_transform)
+        random.shuffle(transforms)
 
         for transform in transforms:
             if random.random() < 0.8:
                 photo, annot = transform(photo, annot)
 
-        if random.random() < 0.5:
-            photo = np.fliplr(photo)
+        flip = random.random() < 0.5
+        if flip:
             annot = np.fliplr(annot)
+            photo = photo[:, ::-1]
+        channels_first = np.empty((photo.shape[2],) + photo.shape[:2], np.float32)
+        low, high = photo.min(), photo.max()
+        photo = np.moveaxis(photo, -1, 0)
+        if low < high:
+            np.subtract(photo, low, out=channels_first)
+            channels_first /= high - low
+        else:
+            channels_first[:] = photo
+        return channels_first, annot
+
+    def guassian_noise_transform(self, photo, annot):
+        sigma = np.abs(self.rng.normal(0, scale=0.09))
+        if self.noise is None or self.noise.shape != photo.shape:
+            self.noise = np.empty(photo.shape, dtype=np.float32)
+        self.rng.standard_normal(dtype=np.float32, out=self.noise)
+        self.noise *= sigma
+        photo += self.noise
+        return photo, annot
 
+    def salt_pepper_transform(self, photo, annot):
+        """as im_utils.add_salt_pepper, in place"""
+        intensity = np.abs(self.rng.normal(0.0, 0.008))
+        num = int(np.ceil(intensity * photo.size))
+        for value in [1, 0]:
+            y_coords = self.rng.integers(0, photo.shape[0], num)
+            x_coords = self.rng.integers(0, photo.shape[1], num)
+            photo[y_coords, x_coords] = value
         return photo, annot
 
+    def elastic_transform(self, photo, annot):
+        if not self.elastic_pool_size:
+            return elastic_transform(photo, annot)
+        shape = photo.shape[:2]
+        if shape not in self.map_pools:
+            self.map_pools[shape] = elastic.ElasticMapPool(
+                shape, self.elastic_pool_size
+            )
+        return elastic_transform(photo, annot, self.map_pools[shape])
+
     def color_jit_transform(self, photo, annot):
-        # TODO check skimage docs for something cleaner to convert
-        # from float to int
-        photo = rescale_intensity(photo, out_range=(0, 255))
-        photo = Image.fromarray((photo).astype(np.int8), mode="RGB")
-        photo = self.color_jit(photo)  # returns PIL image
-        photo = img_as_float32(np.array(photo))  # return back to numpy
+        """color_jit_in_place on a copy of the photo"""
+        return self.color_jit_in_place(photo.astype(np.float32), annot)
+
+    def color_jit_in_place(self, photo, annot):
+        """Randomly change brightness, contrast, saturation and hue in a
+        random order, as torchvision ColorJitter does, but working
+        on the float photo directly instead of converting to a PIL image."""
+        # noise may have moved values outside of 0 to 1, which
+        # would then be clipped by the jitter. Rescale them, as was done
+        # before converting to a PIL image.
+        normalize_in_place(photo)
+        jitters = [
+            (adjust_brightness, self.brightness),
+            (adjust_contrast, self.contrast),
+            (adjust_saturation, self.saturation),
+        ]
+        jitters = [(fn, random.uniform(1 - r, 1 + r)) for fn, r in jitters]
+        jitters.append((adjust_hue, random.uniform(-self.hue, self.hue)))
+        random.shuffle(jitters)
+        for jitter, factor in jitters:
+            jitter(photo, factor)
         return photo, annot
 
 
+def seed_worker(_worker_id):
+    """
+    DataLoader worker_init_fn giving each worker its own augmentation
+    random number generator, seeded from the worker seed chosen by torch.
+    """
+    info = torch.utils.data.get_worker_info()
+    info.dataset.augmentor.seed(info.seed)
+
+
 class TrainDataset(Dataset):
-    def __init__(self, train_annot_dir, dataset_dir, in_w, out_w):
+    def __init__(
+        self,
+        train_annot_dir,
+        dataset_dir,
+        in_w,
+        out_w,
+        weighted=False,
+        batch_elastic=False,
+        elastic_pool_size=0,
+    ):
         """
         in_w and out_w are the tile size in pixels
+        If weighted then images with more annotation are sampled more
+        often, otherwise each image gives the same number of tiles.
+
+        If batch_elastic then the elastic deformation is left to be done
+        on the batch (see elastic.transform_batch) and the annotation is
+        returned at the in_w size, to be cropped after the deformation.
+
+        elastic_pool_size is the number of elastic maps each worker
+        keeps and reuses (see elastic.ElasticMapPool), 0 to make a new
+        map for every tile.
         """
+        self.batch_elastic = batch_elastic
         self.in_w = in_w
         self.out_w = out_w
         self.train_annot_dir = train_annot_dir
         self.dataset_dir = dataset_dir
-        self.augmentor = UNetTransformer()
+        self.weighted = weighted
+        self.augmentor = UNetTransformer(
+            elastic=not batch_elastic, elastic_pool_size=elastic_pool_size
+        )
+        self.cache = TrainImageCache()
 
     def __len__(self):
         # use at least 612 but when dataset gets bigger start to expand
@@ -111,35 +259,17 @@ class TrainDataset(Dataset):
         return max(612, len(ls(self.train_annot_dir)) * 2)
 
     def __getitem__(self, _):
-        image, annot, fname = load_train_image_and_annot(
-            self.dataset_dir, self.train_annot_dir
-        )
         tile_pad = (self.in_w - self.out_w) // 2
 
         # ensures each pixel is sampled with equal chance
         im_pad_w = self.out_w + tile_pad
-        padded_w = image.shape[1] + (im_pad_w * 2)
-        padded_h = image.shape[0] + (im_pad_w * 2)
-        padded_im = im_utils.pad(image, im_pad_w)
-
-        # This speeds up the padding.
-        annot = annot[:, :, :2]
-        padded_annot = im_utils.pad(annot, im_pad_w)
-        right_lim = padded_w - self.in_w
-        bottom_lim = padded_h - self.in_w
-
-        # TODO:
-        # Images with less annotations will still give the same number of
-        # tiles in the training procedure as images with more annotation.
-        # Further empirical investigation into effects of
-        # instance selection required are required.
-        while True:
-            x_in = math.floor(random.random() * right_lim)
-            y_in = math.floor(random.random() * bottom_lim)
-            annot_tile = padded_annot[y_in : y_in + self.in_w, x_in : x_in + self.in_w]
-            if np.sum(annot_tile) > 0:
-                break
-
+        # image and annotation come from the cache already padded, along with
+        # the offsets of the tiles that contain some annotation.
+        padded_im, padded_annot, offsets, fname = self.cache.load_random(
+            self.dataset_dir, self.train_annot_dir, im_pad_w, self.in_w, self.weighted
+        )
+        y_in, x_in = sample_tile_offset(offsets)
+        annot_tile = padded_annot[y_in : y_in + self.in_w, x_in : x_in + self.in_w]
         im_tile = padded_im[y_in : y_in + self.in_w, x_in : x_in + self.in_w]
 
         assert annot_tile.shape == (self.in_w, self.in_w, 2), (
@@ -150,25 +280,22 @@ class TrainDataset(Dataset):
             f" shape is {im_tile.shape} for tile from {fname}"
         )
 
-        im_tile = img_as_float32(im_tile)
-        im_tile = im_utils.normalize_tile(im_tile)
+        # im_tile is returned as normalized float32 (channels, height, width)
         im_tile, annot_tile = self.augmentor.transform(im_tile, annot_tile)
-        im_tile = im_utils.normalize_tile(im_tile)
 
         foreground = np.array(annot_tile)[:, :, 0]
         background = np.array(annot_tile)[:, :, 1]
 
-        # Annotation is cropped post augmentation to ensure
-        # elastic grid doesn't remove the edges.
-        foreground = foreground[tile_pad:-tile_pad, tile_pad:-tile_pad]
-        background = background[tile_pad:-tile_pad, tile_pad:-tile_pad]
+        if not self.batch_elastic:
+            # Annotation is cropped post augmentation to ensure
+            # elastic grid doesn't remove the edges.
+            foreground = foreground[tile_pad:-tile_pad, tile_pad:-tile_pad]
+            background = background[tile_pad:-tile_pad, tile_pad:-tile_pad]
         # mask specified pixels of annotation which are defined
         mask = foreground + background
         mask = mask.astype(np.float32)
         mask = torch.from_numpy(mask)
         foreground = foreground.astype(np.int64)
         foreground = torch.from_numpy(foreground)
-        im_tile = im_tile.astype(np.float32)
-        im_tile = np.moveaxis(im_tile, -1, 0)
         im_tile = torch.from_numpy(im_tile)
         return im_tile, foreground, mask
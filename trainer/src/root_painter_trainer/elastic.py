@@ -26,15 +26,61 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 # pylint: disable=C0111, R0913
+import os
+import random
+import threading
+
 import numpy as np
+import torch
+import torch.nn.functional as F
 from scipy.ndimage import gaussian_filter
 from scipy.ndimage import map_coordinates
-from skimage.transform import resize
+from root_painter_trainer import im_utils
+
+# identity sampling grids for grid_sample, keyed by (height, width, device)
+_base_grids = {}
+# pixel coordinates and interpolation weights reused by get_indices
+_coord_grids = {}
+_zoom_weights = {}
+
+
+def get_coord_grid(shape):
+    """(row, col) coordinates of each pixel for shape, cached"""
+    if shape not in _coord_grids:
+        grid = np.mgrid[0 : shape[0], 0 : shape[1]].astype(np.float32)
+        grid.flags.writeable = False
+        _coord_grids[shape] = grid
+    return _coord_grids[shape]
+
+
+def get_zoom_weights(in_size, out_size):
+    """
+    Source indices and weights for linear interpolation from in_size to
+    out_size, with pixel centres aligned as skimage.transform.resize does.
+    """
+    key = (in_size, out_size)
+    if key not in _zoom_weights:
+        src = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+        src = np.clip(src, 0, in_size - 1)
+        low = np.floor(src).astype(np.int64)
+        high = np.minimum(low + 1, in_size - 1)
+        weight = (src - low).astype(np.float32)
+        _zoom_weights[key] = (low, high, weight)
+    return _zoom_weights[key]
+
+
+def zoom_linear(field, out_shape):
+    """Resize a 2D field to out_shape with separable linear interpolation"""
+    low, high, weight = get_zoom_weights(field.shape[0], out_shape[0])
+    weight = weight[:, None]
+    field = field[low] * (1 - weight) + field[high] * weight
+    low, high, weight = get_zoom_weights(field.shape[1], out_shape[1])
+    return field[:, low] * (1 - weight) + field[:, high] * weight
 
 
 def get_indices(im_shape, scale, sigma, padding=60):
     """based on cognitivemedium.com/assets/rmnist/Simard.pdf"""
-    im_shape = [im_shape[0] + (padding * 2), im_shape[1] + (padding * 2)]
+    im_shape = (im_shape[0] + (padding * 2), im_shape[1] + (padding * 2))
 
     # We generate a grid of smalelr coordinates and then resize
     # It's faster as less guassian_filtering.
@@ -45,20 +91,21 @@ def get_indices(im_shape, scale, sigma, padding=60):
     sigma /= resize_coef / 2
     scale /= resize_coef / 2
 
-    randx = np.random.uniform(low=-1.0, high=1.0, size=smaller)
-    randy = np.random.uniform(low=-1.0, high=1.0, size=smaller)
+    randx = np.random.uniform(low=-1.0, high=1.0, size=smaller).astype(np.float32)
+    randy = np.random.uniform(low=-1.0, high=1.0, size=smaller).astype(np.float32)
     x_filtered = gaussian_filter(randx, sigma, mode="reflect") * scale
     y_filtered = gaussian_filter(randy, sigma, mode="reflect") * scale
 
-    x_filtered = resize(x_filtered, im_shape[:2])
-    y_filtered = resize(y_filtered, im_shape[:2])
-    x_coords, y_coords = np.mgrid[0 : im_shape[0], 0 : im_shape[1]]
-    x_deformed = x_coords + x_filtered
-    y_deformed = y_coords + y_filtered
-    return x_deformed, y_deformed
+    # (row, col) coordinates to sample from for each pixel.
+    indices = np.empty((2,) + im_shape, dtype=np.float32)
+    coords = get_coord_grid(im_shape)
+    np.add(coords[0], zoom_linear(x_filtered, im_shape), out=indices[0])
+    np.add(coords[1], zoom_linear(y_filtered, im_shape), out=indices[1])
+    return indices
 
 
-def get_elastic_map(im_shape, scale, intensity):
+def get_elastic_params(scale, intensity):
+    """alpha (displacement scale) and sigma (smoothness) of the deformation"""
     assert 0 <= scale <= 1
     assert 0 <= intensity <= 1
     min_alpha = 200
@@ -68,9 +115,70 @@ def get_elastic_map(im_shape, scale, intensity):
     alpha = min_alpha + ((max_alpha - min_alpha) * scale)
     alpha *= intensity
     sigma = min_sigma + ((max_sigma - min_sigma) * scale)
+    return alpha, sigma
+
+
+def get_elastic_map(im_shape, scale, intensity):
+    alpha, sigma = get_elastic_params(scale, intensity)
     return get_indices(im_shape, scale=alpha, sigma=sigma)
 
 
+def get_random_elastic_map(im_shape):
+    """elastic map with the random scale and intensity used for training"""
+    return get_elastic_map(
+        im_shape, scale=random.random(), intensity=0.4 + (0.6 * random.random())
+    )
+
+
+class ElasticMapPool:
+    """
+    A pool of random elastic maps for one tile shape, so a new map doesn't
+    have to be made for every tile. A background thread replaces a random
+    map in the pool after every refresh_every maps are used, so the maps
+    keep changing.
+
+    Each map for a 572 tile is about 4MB, and each data loader
+    worker has its own pool.
+    """
+
+    def __init__(self, im_shape, size=8, refresh_every=4):
+        self.im_shape = tuple(im_shape[:2])
+        self.size = size
+        self.refresh_every = refresh_every
+        self.maps = []
+        self.used = 0
+        self.lock = threading.Lock()
+        self.refresh_needed = threading.Event()
+        # the thread is started in the process that uses the pool,
+        # as threads don't survive the fork of data loader workers.
+        self.pid = None
+
+    def get(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.maps = [get_random_elastic_map(self.im_shape)]
+            threading.Thread(target=self.refresh, daemon=True).start()
+        if len(self.maps) < self.size:
+            # fill the pool before reusing maps.
+            new_map = get_random_elastic_map(self.im_shape)
+            with self.lock:
+                self.maps.append(new_map)
+            return new_map
+        self.used += 1
+        if self.used % self.refresh_every == 0:
+            self.refresh_needed.set()
+        with self.lock:
+            return random.choice(self.maps)
+
+    def refresh(self):
+        while True:
+            self.refresh_needed.wait()
+            self.refresh_needed.clear()
+            new_map = get_random_elastic_map(self.im_shape)
+            with self.lock:
+                self.maps[random.randrange(len(self.maps))] = new_map
+
+
 def transform_image(image, def_map, padding=60, channels=3):
     """conditional transform, depending on presence of
     values in each channel"""
@@ -83,3 +191,107 @@ def transform_image(image, def_map, padding=60, channels=3):
             image[:, :, i] = map_coordinates(image[:, :, i], indices, order=1)
     image = image[padding:-padding, padding:-padding]
     return image
+
+
+def get_base_grid(height, width, device):
+    """identity grid for grid_sample (align_corners=True), cached"""
+    key = (height, width, str(device))
+    if key not in _base_grids:
+        rows = torch.linspace(-1, 1, height, device=device)
+        cols = torch.linspace(-1, 1, width, device=device)
+        row_grid, col_grid = torch.meshgrid(rows, cols, indexing="ij")
+        # grid_sample wants (x, y) order.
+        _base_grids[key] = torch.stack([col_grid, row_grid], dim=-1)
+    return _base_grids[key]
+
+
+def gaussian_blur_batch(fields, sigmas):
+    """
+    Blur each of fields (n, channels, h, w) with its own sigma from
+    sigmas (a list of n floats), using a separable gaussian with
+    reflected edges.
+    """
+    n, channels, height, width = fields.shape
+    radius = int(min(4 * max(sigmas) + 0.5, height - 1, width - 1))
+    offsets = torch.arange(-radius, radius + 1, device=fields.device).float()
+    sigmas = torch.tensor(sigmas, device=fields.device).float()
+    kernels = torch.exp(-0.5 * (offsets[None] / sigmas[:, None]) ** 2)
+    kernels /= kernels.sum(dim=1, keepdim=True)
+    kernels = kernels.repeat_interleave(channels, dim=0)
+    # every channel of every field is blurred separately, as a group.
+    out = fields.reshape(1, n * channels, height, width)
+    out = F.pad(out, (radius, radius, radius, radius), mode="reflect")
+    out = F.conv2d(out, kernels[:, None, :, None], groups=n * channels)
+    out = F.conv2d(out, kernels[:, None, None, :], groups=n * channels)
+    return out.reshape(n, channels, height, width)
+
+
+def normalize_batch(photos):
+    """im_utils.normalize_tile for each tile in a batch of tensors"""
+    flat = photos.reshape(len(photos), -1)
+    mins = flat.min(dim=1).values
+    ranges = flat.max(dim=1).values - mins
+    # tiles with a single value are left as they are.
+    constant = ranges == 0
+    mins = mins.masked_fill(constant, 0)
+    ranges = ranges.masked_fill(constant, 1)
+    photos = (photos - mins[:, None, None, None]) / ranges[:, None, None, None]
+    return photos.clamp_(0, 1)
+
+
+def transform_batch(photos, annots, probability=0.8, padding=60, resize_coef=8):
+    """
+    Elastic deformation of a batch of tiles on the device they are on.
+    Deforms each tile with {probability} in the same way as get_elastic_map
+    and transform_image, but with grid_sample for the whole batch at once.
+
+    photos is (n, 3, h, w) and annots is (n, channels, h, w), both float.
+    Returns the deformed photos, normalised again, and the deformed
+    annotations, rounded to 0 or 1.
+    """
+    chosen = [i for i in range(len(photos)) if random.random() < probability]
+    if not chosen:
+        return photos, annots
+    params = [
+        get_elastic_params(random.random(), 0.4 + (0.6 * random.random()))
+        for _ in chosen
+    ]
+    # The displacement is generated at 1/resize_coef of the size and then
+    # resized, as in get_indices.
+    alphas = [alpha / (resize_coef / 2) for alpha, _ in params]
+    sigmas = [sigma / (resize_coef / 2) for _, sigma in params]
+    _, _, height, width = photos.shape
+    padded_h, padded_w = height + (padding * 2), width + (padding * 2)
+    small = (padded_h // resize_coef, padded_w // resize_coef)
+    noise = torch.rand((len(chosen), 2) + small, device=photos.device) * 2 - 1
+    fields = gaussian_blur_batch(noise, sigmas)
+    fields *= torch.tensor(alphas, device=photos.device)[:, None, None, None]
+    fields = F.interpolate(
+        fields, size=(padded_h, padded_w), mode="bilinear", align_corners=False
+    )
+    # Outside of the tile, reflection by grid_sample replaces the padding.
+    fields = fields[:, :, padding : padding + height, padding : padding + width]
+    # fields are row and column displacements in pixels.
+    grid = get_base_grid(height, width, photos.device) + torch.stack(
+        [fields[:, 1] * (2 / (width - 1)), fields[:, 0] * (2 / (height - 1))], dim=-1
+    )
+    chosen = torch.tensor(chosen, device=photos.device)
+    photos = photos.clone()
+    annots = annots.clone()
+    deformed_photos = F.grid_sample(
+        photos[chosen],
+        grid,
+        mode="bilinear",
+        padding_mode="reflection",
+        align_corners=True,
+    )
+    photos[chosen] = normalize_batch(deformed_photos)
+    deformed_annots = F.grid_sample(
+        annots[chosen],
+        grid,
+        mode="bilinear",
+        padding_mode="reflection",
+        align_corners=True,
+    )
+    annots[chosen] = torch.round(deformed_annots)
+    return photos, annots
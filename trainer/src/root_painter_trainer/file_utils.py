@@ -16,6 +16,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def ls(dir_path):
@@ -25,3 +27,27 @@ def ls(dir_path):
     fnames = os.listdir(dir_path)
     fnames = [f for f in fnames if f[0] != "."]
     return fnames
+
+
+def annot_fingerprint(annot_dir):
+    """names and modification times of the files in annot_dir.
+    Changes whenever an annotation is added, removed or updated."""
+    fingerprint = []
+    for fname in ls(annot_dir):
+        fpath = os.path.join(annot_dir, fname)
+        fingerprint.append((fname, os.path.getmtime(fpath)))
+    return tuple(sorted(fingerprint))
+
+
+def prefetch_map(fn, items, num_workers, depth):
+    """Like map(fn, items) but fn is run ahead of time in a pool of
+    {num_workers} threads. At most {depth} results are held waiting
+    to be used, which bounds the memory used by prefetching."""
+    with ThreadPoolExecutor(num_workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
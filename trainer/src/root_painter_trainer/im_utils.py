@@ -20,9 +20,12 @@ import os
 import time
 import glob
 import shutil
+import struct
+import zlib
 from math import ceil
 import random
 import numpy as np
+import tifffile
 
 from PIL import Image, ImageOps
 from skimage import color
@@ -204,11 +207,46 @@ def get_tiles(image, in_tile_shape, out_tile_shape):
     return tiles, tile_coords
 
 
-def reconstruct_from_tiles(tiles, coords, output_shape):
-    image = np.zeros(output_shape)
+def reconstruct_from_tiles(tiles, coords, output_shape, dtype=np.float32, out=None):
+    """Place each of {tiles} (can be any iterable) at its coords.
+    {out} is an optional preallocated output to write to."""
+    if out is None:
+        out = np.zeros(output_shape, dtype=dtype)
     for tile, (x, y) in zip(tiles, coords):
-        image[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
-    return image
+        out[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
+    return out
+
+
+def tiles_to_batch(tiles, out=None):
+    """Copy {tiles} (height, width, channels) into a float32 batch
+    (tiles, channels, height, width) ready for the network.
+    Each tile is converted to float and normalized, giving the same result
+    as img_as_float32 followed by normalize_tile.
+    {out} is an optional preallocated batch with room for at least len(tiles)"""
+    if out is None:
+        h, w, c = tiles[0].shape
+        out = np.empty((len(tiles), c, h, w), dtype=np.float32)
+    batch = out[: len(tiles)]
+    for tile, batch_tile in zip(tiles, batch):
+        batch_tile[:] = np.moveaxis(tile, -1, 0)
+    if np.issubdtype(tiles[0].dtype, np.unsignedinteger):
+        batch /= np.iinfo(tiles[0].dtype).max
+    return normalize_tiles(batch)
+
+
+def normalize_tiles(batch):
+    """normalize_tile for each tile in a float batch, in place."""
+    flat = batch.reshape(len(batch), -1)
+    mins = flat.min(axis=1, keepdims=True)
+    ranges = flat.max(axis=1, keepdims=True) - mins
+    # tiles with a single value are left as they are.
+    constant = ranges == 0
+    mins[constant] = 0
+    ranges[constant] = 1
+    flat -= mins
+    flat /= ranges
+    np.clip(flat, 0, 1, out=flat)
+    return batch
 
 
 def tiles_from_coords(image, coords, tile_shape):
@@ -236,7 +274,11 @@ def save_then_move(out_path, seg_output, npy=False):
         np.savez_compressed(temp_path, seg=seg_output)
     else:
         imsave(temp_path, seg_output, check_contrast=False)
+    move_into_place(temp_path, out_path)
+
 
+def move_into_place(temp_path, out_path):
+    """move a completely written temp_path to out_path. See save_then_move"""
     attempts = 0
     max_attempts = 50
     # we found on google colab that writing a file doesn't mean
@@ -254,6 +296,12 @@ def save_then_move(out_path, seg_output, npy=False):
     )
 
 
+def get_image_size(image_path):
+    """(width, height) of the image, without decoding it"""
+    with Image.open(image_path) as image:
+        return image.size
+
+
 def load_image(photo_path):
     photo = Image.open(photo_path)
     # Convert to RGB before converting to NumPy due to bug in Pillow
@@ -276,3 +324,165 @@ def load_image(photo_path):
         photo = color.gray2rgb(photo)
 
     return photo
+
+
+class ImageBandReader:
+    """
+    Read horizontal bands of rows from an image as RGB, for images
+    too large to hold in memory as a whole.
+
+    8 bit TIFF files, typical for large images, are read with tifffile.
+    Uncompressed ones are memory-mapped and for compressed ones only the
+    strips (or tiles) overlapping the requested rows are decoded.
+    Other images can't be read in bands so are decoded as a whole,
+    which is reported when the reader is created.
+    """
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.tiff = None
+        self.array = None  # memory-mapped image
+        self.image = None
+        # decoded strips of the last band read, by index, as the next
+        # band usually starts in the last strip.
+        self.segments = {}
+        try:
+            self.open_tiff()
+        except Exception as e:
+            print("Could not read", image_path, "with tifffile", e)
+            self.close()
+        # True if bands are read without decoding the full image.
+        self.strips = self.tiff is not None
+        if not self.strips:
+            print(image_path, "can't be read in bands so will be decoded as a whole")
+            self.image = ImageOps.exif_transpose(Image.open(image_path))
+            self.width, self.height = self.image.size
+
+    def open_tiff(self):
+        if os.path.splitext(self.image_path)[1].lower() not in (".tif", ".tiff"):
+            return
+        self.tiff = tifffile.TiffFile(self.image_path)
+        page = self.tiff.pages[0]
+        orientation = page.tags.get(274)  # rotated images are decoded whole.
+        supported = (
+            (orientation is None or orientation.value == 1)
+            and page.dtype == np.uint8
+            and page.planarconfig == 1  # samples of each pixel together
+            and page.imagedepth == 1
+            and (
+                (page.photometric == 1 and page.samplesperpixel == 1)  # grey
+                or (page.photometric == 2 and page.samplesperpixel in (3, 4))
+            )
+        )
+        if page.is_tiled:
+            self.segment_rows = page.tilelength
+            self.segments_across = ceil(page.imagewidth / page.tilewidth)
+        else:
+            self.segment_rows = page.rowsperstrip
+            self.segments_across = 1
+        self.height, self.width = page.imagelength, page.imagewidth
+        if supported and page.is_memmappable:
+            self.array = tifffile.memmap(self.image_path, page=0, mode="r")
+        elif not supported or len(page.dataoffsets) == 1:
+            # a single compressed strip must be decoded as a whole.
+            self.close()
+
+    def read(self, top, bottom):
+        """rows top to bottom of the image, as a uint8 RGB array"""
+        if self.array is not None:
+            band = np.asarray(self.array[top:bottom])
+        elif self.tiff is not None:
+            band = self.read_segments(top, bottom)
+        else:
+            band = self.image.crop((0, top, self.width, bottom))
+            return np.array(band.convert("RGB"))
+        # as load_image, which converts to RGB with Pillow
+        if band.ndim == 2:
+            band = band[:, :, np.newaxis]
+        if band.shape[2] == 1:
+            return np.repeat(band, 3, axis=2)
+        return np.ascontiguousarray(band[:, :, :3])
+
+    def read_segments(self, top, bottom):
+        page = self.tiff.pages[0]
+        band = np.zeros((bottom - top, self.width, page.samplesperpixel), np.uint8)
+        first_row = top // self.segment_rows
+        last_row = (bottom - 1) // self.segment_rows
+        segments = {}
+        for row in range(first_row, last_row + 1):
+            for col in range(self.segments_across):
+                index = row * self.segments_across + col
+                if index in self.segments:
+                    segments[index] = self.segments[index]
+                    continue
+                if not page.databytecounts[index]:
+                    continue  # missing segments are left as 0.
+                self.tiff.filehandle.seek(page.dataoffsets[index])
+                data = self.tiff.filehandle.read(page.databytecounts[index])
+                segment, indices, _ = page.decode(
+                    data, index, jpegtables=page.jpegtables
+                )
+                # segment is (depth, height, width, samples)
+                # and indices end in the (y, x) position of the segment.
+                segments[index] = (segment[0], indices[-3], indices[-2])
+        for segment, y, x in segments.values():
+            # segments at the edge may be padded beyond the image.
+            y0 = max(y, top)
+            y1 = min(y + segment.shape[0], bottom, self.height)
+            x1 = min(x + segment.shape[1], self.width)
+            band[y0 - top : y1 - top, x:x1] = segment[y0 - y : y1 - y, : x1 - x]
+        self.segments = segments
+        return band
+
+    def close(self):
+        if self.tiff is not None:
+            self.array = None
+            self.segments = {}
+            self.tiff.close()
+            self.tiff = None
+        if self.image is not None:
+            self.image.close()
+
+
+class PNGRowWriter:
+    """
+    Write an 8 bit PNG a band of rows at a time,
+    so the full image never needs to be in memory.
+    """
+
+    color_types = {1: 0, 3: 2, 4: 6}  # grey, RGB and RGBA
+
+    def __init__(self, path, width, height, channels):
+        self.file = open(path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        header = struct.pack(
+            ">IIBBBBB", width, height, 8, self.color_types[channels], 0, 0, 0
+        )
+        self.write_chunk(b"IHDR", header)
+        self.compressor = zlib.compressobj(6)
+
+    def write_rows(self, rows):
+        rows = rows.astype(np.uint8).reshape(len(rows), -1)
+        # each row starts with a filter type byte (0 is no filtering)
+        filtered = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.write_chunk(b"IDAT", data)
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    def close(self):
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
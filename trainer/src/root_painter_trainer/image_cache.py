@@ -0,0 +1,247 @@
+"""
+Cache of decoded training images and annotations shared by the
+data loader workers.
+
+Copyright (C) 2020 Abraham George Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# pylint: disable=C0111, R0913
+import os
+import glob
+import time
+import random
+import hashlib
+import tempfile
+
+import numpy as np
+from skimage.io import imread
+
+from root_painter_trainer import im_utils
+from root_painter_trainer.file_utils import ls
+
+
+class TrainImageCache:
+    """
+    Decoded, padded training images and annotations stored as .npy files
+    and memory-mapped when used. The data loader worker processes share
+    them through the operating system page cache, so each image is decoded
+    once instead of for every training sample.
+
+    Entries are keyed by annotation path, padding and annotation mtime, so
+    an updated annotation is decoded again. The least recently used entries
+    are removed when the cache is larger than max_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=4 * 1024**3, list_interval=2.0):
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), "root_painter_cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # listing the annotation dir for every sample is slow on
+        # network file systems so the listing is reused for list_interval.
+        self.list_interval = list_interval
+        self.annot_fnames = {}
+        self.image_paths = {}
+        self.defined_counts = {}
+
+    def list_annots(self, annot_dir):
+        listed_time, fnames = self.annot_fnames.get(annot_dir, (0, None))
+        if fnames is None or time.time() - listed_time > self.list_interval:
+            fnames = [a for a in ls(annot_dir) if im_utils.is_photo(a)]
+            self.annot_fnames[annot_dir] = (time.time(), fnames)
+        return fnames
+
+    def get_image_path(self, dataset_dir, fname):
+        key = (dataset_dir, fname)
+        if key not in self.image_paths:
+            image_path_part = os.path.join(dataset_dir, os.path.splitext(fname)[0])
+            # it's possible the image has a different extension
+            # so use glob to get it
+
+            # Use glob.escape to allow arbitrary strings in file paths,
+            # including [ and ]
+            # For related bug See https://github.com/Abe404/root_painter/issues/87
+            image_path_part = glob.escape(image_path_part)
+            self.image_paths[key] = glob.glob(image_path_part + ".*")[0]
+        return self.image_paths[key]
+
+    def entry_paths(self, annot_path, pad_w, in_w):
+        """paths of the files cached for the current version of the annotation"""
+        key = hashlib.sha1(os.path.abspath(annot_path).encode("utf-8")).hexdigest()
+        mtime = os.stat(annot_path).st_mtime_ns
+        prefix = os.path.join(self.cache_dir, key)
+        entry = f"{prefix}_{pad_w}_{in_w}_{mtime}"
+        names = ["im", "annot", "offsets", "offset_counts", "defined"]
+        return prefix, [f"{entry}_{name}.npy" for name in names]
+
+    def load_random(self, dataset_dir, annot_dir, pad_w, in_w, weighted=False):
+        """
+        Return a random padded image, annotation, tile offsets (see get)
+        and fname from annot_dir.
+
+        If weighted then images are picked with probability in proportion
+        to how much of their annotation is defined, otherwise all
+        images have the same chance of being picked.
+
+        Retries if there are problems loading the files, as is done
+        by im_utils.load_train_image_and_annot.
+        """
+        max_attempts = 60
+        latest_fname = None
+        latest_error = None
+        for _ in range(max_attempts):
+            # file systems are unpredictable.
+            # We may have problems reading the file.
+            # try-catch to avoid this.
+            # (just try again)
+            try:
+                latest_fname = None
+                fnames = self.list_annots(annot_dir)
+                weights = None
+                if weighted:
+                    weights = self.get_defined_weights(annot_dir, fnames)
+                fname = random.choices(fnames, weights)[0]
+                latest_fname = fname
+                image, annot, offsets = self.get(
+                    dataset_dir, annot_dir, fname, pad_w, in_w
+                )
+                return image, annot, offsets, fname
+            except Exception as e:
+                latest_error = e
+                # This could be due to an empty annotation saved by the user.
+                # give it some time and try again.
+                time.sleep(0.1)
+        raise Exception(f"Could not load {latest_fname}, {latest_error}")
+
+    def get_defined_weights(self, annot_dir, fnames):
+        """Defined pixel count for each of fnames. Images that haven't
+        been loaded yet are given the mean of the others."""
+        counts = [self.defined_counts.get((annot_dir, f)) for f in fnames]
+        known = [c for c in counts if c is not None]
+        mean_count = np.mean(known) if known else 1
+        return [mean_count if c is None else c for c in counts]
+
+    def get(self, dataset_dir, annot_dir, fname, pad_w, in_w):
+        """
+        Return the image and the first two (foreground and background)
+        channels of the annotation for fname, both padded by pad_w, along
+        with the offsets of the in_w tiles that contain defined annotation
+        (see sample_tile_offset).
+        Raises an exception if the annotation is empty.
+        """
+        annot_path = os.path.join(annot_dir, fname)
+        prefix, paths = self.entry_paths(annot_path, pad_w, in_w)
+        try:
+            arrays = [np.load(path, mmap_mode="r") for path in paths]
+            now = time.time()
+            for path in paths:
+                # modification time is used to find the least recently used.
+                os.utime(path, (now, now))
+        except (OSError, ValueError):
+            # not cached yet (or being written by another worker)
+            arrays = self.load(dataset_dir, annot_path, fname, pad_w, in_w)
+            # remove entries for older versions of this annotation.
+            for old_path in glob.glob(glob.escape(prefix) + "_*.npy"):
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+            for path, array in zip(paths, arrays):
+                self.save(path, array)
+            self.evict()
+        image, annot, valid, valid_counts, defined = arrays
+        self.defined_counts[(annot_dir, fname)] = int(defined)
+        return image, annot, (valid, valid_counts)
+
+    def load(self, dataset_dir, annot_path, fname, pad_w, in_w):
+        image = im_utils.load_image(self.get_image_path(dataset_dir, fname))
+        assert image.shape[2] == 3  # should be RGB
+        annot = imread(annot_path).astype(bool)
+        assert np.sum(annot) > 0
+        image = im_utils.pad(image, pad_w)
+        annot = im_utils.pad(annot[:, :, :2], pad_w)
+        valid = get_valid_tile_offsets(annot, in_w)
+        valid_counts = np.cumsum(np.sum(valid, axis=1))
+        defined = np.array(np.count_nonzero(np.any(annot, axis=2)))
+        return image, annot, valid, valid_counts, defined
+
+    def save(self, path, array):
+        # other workers may be reading the cache so write to a
+        # temporary file and then rename it, which is atomic.
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as temp_file:
+            np.save(temp_file, array)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        """remove least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(".npy"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, fname))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(e[1] for e in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                # files memory-mapped by another worker stay readable
+                # until that worker is done with them.
+                os.remove(os.path.join(self.cache_dir, fname))
+                total -= size
+            except OSError:
+                pass
+
+
+def get_valid_tile_offsets(annot, in_w):
+    """
+    For each (y, x) tile offset in annot (height, width, channels),
+    True if the in_w tile at that offset contains defined annotation.
+    Offsets range up to (but not including) height - in_w and width - in_w,
+    matching the offsets that were sampled by TrainDataset.
+
+    Uses an integral image (summed area table) so the number of defined
+    pixels in every tile is found in a few array operations.
+    """
+    defined = np.any(annot, axis=2)
+    dtype = np.int32 if defined.size < 2**31 else np.int64
+    integral = np.zeros((defined.shape[0] + 1, defined.shape[1] + 1), dtype=dtype)
+    np.cumsum(defined, axis=0, dtype=dtype, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    tile_sums = (
+        integral[in_w:-1, in_w:-1]
+        - integral[: -in_w - 1, in_w:-1]
+        - integral[in_w:-1, : -in_w - 1]
+        + integral[: -in_w - 1, : -in_w - 1]
+    )
+    return tile_sums > 0
+
+
+def sample_tile_offset(offsets):
+    """
+    Pick one of the valid tile offsets with equal chance, returning (y, x).
+    {offsets} is (valid, valid_counts) where valid_counts is the cumulative
+    count of valid offsets in each row of valid.
+    """
+    valid, valid_counts = offsets
+    k = random.randrange(int(valid_counts[-1]))
+    y = int(np.searchsorted(valid_counts, k, side="right"))
+    before = int(valid_counts[y - 1]) if y > 0 else 0
+    x = int(np.flatnonzero(valid[y])[k - before])
+    return y, x
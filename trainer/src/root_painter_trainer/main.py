@@ -36,11 +36,82 @@ parser.add_argument(
     default=12,
     help=("maximum number of workers used for the dataloader"),
 )
+parser.add_argument(
+    "--device",
+    help=(
+        "device to train and segment with i.e cuda, cuda:1, mps or cpu. "
+        "Defaults to cuda if available, then mps, then cpu"
+    ),
+)
+parser.add_argument(
+    "--watcher",
+    default="auto",
+    choices=["auto", "inotify", "poll"],
+    help=(
+        "how to watch for new instructions. inotify is faster but only works "
+        "for local file systems on Linux. auto picks inotify when possible"
+    ),
+)
+parser.add_argument(
+    "--precision",
+    default="fp32",
+    choices=["fp32", "mixed"],
+    help=(
+        "mixed runs the network in float16 on GPU or bfloat16 on CPU, "
+        "which is faster on hardware that supports it"
+    ),
+)
+parser.add_argument(
+    "--batchelastic",
+    action="store_true",
+    help=(
+        "do the elastic deformation of training tiles for the whole batch "
+        "on the device instead of in the dataloader workers"
+    ),
+)
+parser.add_argument(
+    "--prefetchfactor",
+    type=int,
+    default=2,
+    help=("number of batches loaded in advance by each dataloader worker"),
+)
+parser.add_argument(
+    "--nopersistentworkers",
+    action="store_true",
+    help=("start new dataloader workers for every epoch instead of keeping them"),
+)
+parser.add_argument(
+    "--batchsize",
+    type=int,
+    help=(
+        "tiles in each training batch. By default the largest batch that "
+        "fits in GPU memory (up to 12), or 1 on CPU"
+    ),
+)
+parser.add_argument(
+    "--effectivebatchsize",
+    type=int,
+    help=(
+        "accumulate gradients over several batches to make up this many "
+        "tiles for each optimizer step, so training behaves the same with "
+        "different GPU memory"
+    ),
+)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
     trainer = Trainer(
-        sync_dir=args.syncdir, patch_size=args.patchsize, max_workers=args.maxworkers
+        sync_dir=args.syncdir,
+        patch_size=args.patchsize,
+        max_workers=args.maxworkers,
+        device=args.device,
+        watcher=args.watcher,
+        precision=args.precision,
+        batch_elastic=args.batchelastic,
+        prefetch_factor=args.prefetchfactor,
+        persistent_workers=not args.nopersistentworkers,
+        batch_size=args.batchsize,
+        effective_batch_size=args.effectivebatchsize,
     )
     trainer.main_loop()
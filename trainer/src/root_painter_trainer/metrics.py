@@ -20,6 +20,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 # pylint: disable=C0111,R0913
 from datetime import datetime
 import numpy as np
+import torch
 
 
 def get_metrics_str(all_metrics, to_use=None):
@@ -77,3 +78,53 @@ def get_metrics(tp, fp, tn, fn, defined_sum, duration, loss=float("nan")):
         "duration": duration,
         "loss": loss,
     }
+
+
+class MetricAccumulator:
+    """
+    Sum of the TP, FP, TN, FN, defined pixel count and loss over many batches.
+
+    The sums are kept as tensors on the device the batches are on, so adding
+    a batch doesn't wait for the device to finish its work. They are only
+    copied to the host when read with values or get_metrics.
+    """
+
+    def __init__(self):
+        # counts of TN, FP, FN, TP in that order.
+        self.counts = None
+        self.loss_sum = None
+        self.loss_count = 0
+
+    def add(self, predicted, foreground, defined, loss=None):
+        """
+        predicted and foreground are 0/1 tensors and defined is a
+        tensor which is > 0 where the annotation is defined. Only defined
+        pixels are counted. loss is the (mean) loss for the batch.
+        """
+        # pixels are binned by 2 * foreground + predicted, which gives the
+        # confusion matrix from one op. Undefined pixels go to an extra bin.
+        bins = foreground.reshape(-1).long() * 2 + predicted.reshape(-1).long()
+        bins = bins.masked_fill(defined.reshape(-1) <= 0, 4)
+        if self.counts is None:
+            self.counts = torch.zeros(5, dtype=torch.long, device=bins.device)
+        # torch.bincount would copy the max bin to the host, index_add_ doesn't.
+        self.counts.index_add_(0, bins, torch.ones_like(bins))
+        if loss is not None:
+            loss = loss.detach()
+            self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+            self.loss_count += 1
+
+    def values(self):
+        """tp, fp, tn, fn, defined_sum and mean loss as python numbers"""
+        if self.counts is None:
+            tn = fp = fn = tp = 0
+        else:
+            tn, fp, fn, tp = self.counts[:4].tolist()
+        loss = float("nan")
+        if self.loss_sum is not None:
+            loss = self.loss_sum.item() / self.loss_count
+        return tp, fp, tn, fn, tp + fp + tn + fn, loss
+
+    def get_metrics(self, duration):
+        tp, fp, tn, fn, defined_sum, loss = self.values()
+        return get_metrics(tp, fp, tn, fn, defined_sum, duration, loss)
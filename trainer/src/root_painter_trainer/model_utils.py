@@ -20,26 +20,126 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import os
 import time
 import glob
+import random
+import inspect
+import hashlib
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
 import numpy as np
 import torch
 from torch.nn.functional import softmax
 from skimage.io import imread
-from skimage import img_as_float32
 from root_painter_trainer import im_utils
 from root_painter_trainer.unet import UNetGNRes
-from root_painter_trainer.metrics import get_metrics
+from root_painter_trainer.metrics import MetricAccumulator
 from root_painter_trainer.file_utils import ls
 from root_painter_trainer.loss import combined_loss as criterion
 
 
-def get_device():
+def get_device(name=None):
+    """
+    Get the device used for training and segmentation.
+    {name} can be any torch device string i.e 'cuda', 'cuda:1', 'mps' or 'cpu'.
+    If not specified then use cuda if available, then mps, then cpu.
+    """
+    if name:
+        return torch.device(name)
+    if torch.cuda.is_available():
+        return torch.device("cuda")
     if torch.backends.mps.is_available():
         return torch.device("mps")
-    return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def set_device(name=None, num_threads=None):
+    """
+    Set the device used by the functions in this module.
+    When running on CPU, torch is told to use {num_threads} threads,
+    defaulting to the number of CPUs available to this process.
+    """
+    global device
+    device = get_device(name)
+    if device.type == "cpu":
+        if num_threads is None:
+            if hasattr(os, "sched_getaffinity"):
+                num_threads = len(os.sched_getaffinity(0))
+            else:
+                num_threads = os.cpu_count()
+        torch.set_num_threads(num_threads)
+    return device
 
 
 device = get_device()  # used in epoch function etc.
 
+# 'fp32' or 'mixed'. With mixed precision the network runs under autocast
+# (float16 on CUDA, bfloat16 on CPU) with channels last tensors.
+precision = "fp32"
+
+
+def set_precision(name="fp32"):
+    """Set the precision used by the functions in this module"""
+    global precision
+    assert name in ("fp32", "mixed"), f"Unknown precision {name}"
+    precision = name
+    return precision
+
+
+def get_autocast_dtype():
+    """Type used by autocast, or None if the network runs in float32"""
+    if precision == "mixed":
+        if device.type == "cuda":
+            return torch.float16
+        if device.type == "cpu":
+            return torch.bfloat16
+    # autocast support on other devices such as mps varies by torch version.
+    return None
+
+
+def autocast():
+    """Context for running the network in the precision set by set_precision"""
+    dtype = get_autocast_dtype()
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=dtype)
+
+
+def get_grad_scaler():
+    """
+    GradScaler for training. float16 gradients can underflow so the loss
+    is scaled. The scaler does nothing unless float16 is used.
+    """
+    return torch.cuda.amp.GradScaler(enabled=get_autocast_dtype() == torch.float16)
+
+
+def to_device(tensor, non_blocking=False):
+    """Move network input to the device, as channels last for mixed precision"""
+    if get_autocast_dtype() is not None:
+        return tensor.to(
+            device, non_blocking=non_blocking, memory_format=torch.channels_last
+        )
+    return tensor.to(device, non_blocking=non_blocking)
+
+
+# Models used for segmentation and validation are kept in memory so that
+# segmenting a folder of images doesn't load the same checkpoint from disk
+# for every image. Entries are keyed by path and mtime so a checkpoint that
+# is replaced on disk is loaded again. Least recently used models are evicted
+# once more than model_cache_size are held.
+model_cache_size = 4
+_model_cache = OrderedDict()
+# Inference engines built from the cached models, see get_inference_engine.
+_engine_cache = OrderedDict()
+# Files derived from checkpoints, such as ONNX exports, are kept here
+# rather than in the models folder, where the painter expects only
+# checkpoints.
+derived_model_dir = os.path.join(tempfile.gettempdir(), "root_painter_models")
+# The caches are used by the validation thread as well as for segmenting.
+_cache_lock = threading.RLock()
+
 
 def get_latest_model_paths(model_dir, k):
     fnames = ls(model_dir)
@@ -48,32 +148,407 @@ def get_latest_model_paths(model_dir, k):
     return fpaths
 
 
-def load_model(model_path):
+def model_to_device(model):
+    """Move model to the device, using DataParallel when on GPU"""
+    model.to(device)
+    if get_autocast_dtype() is not None:
+        model.to(memory_format=torch.channels_last)
+    if device.type == "cuda":
+        # use all GPUs unless a specific one was asked for.
+        device_ids = None if device.index is None else [device.index]
+        model = torch.nn.DataParallel(model, device_ids=device_ids)
+    return model
+
+
+def load_weights(model_path, map_location=None):
+    """UNetGNRes with the weights from model_path, not moved to the device"""
+    state_dict = torch.load(model_path, map_location=map_location or device)
+    # Models saved whilst wrapped in DataParallel have
+    # 'module.' at the start of each key.
+    prefix = "module."
+    state_dict = {
+        (k[len(prefix) :] if k.startswith(prefix) else k): v
+        for k, v in state_dict.items()
+    }
     model = UNetGNRes()
-    if torch.cuda.is_available():
-        try:
-            model.load_state_dict(torch.load(model_path))
-            model = torch.nn.DataParallel(model)
-        except:
-            model = torch.nn.DataParallel(model)
-            model.load_state_dict(torch.load(model_path))
-        model.cuda()
-    else:
-        # if you are running on a CPU-only machine, please use torch.load with
-        # map_location=torch.device('cpu') to map your storages to the CPU.
-        try:
-            model.load_state_dict(
-                torch.load(model_path, map_location=torch.device("cpu"))
-            )
-            model = torch.nn.DataParallel(model)
-        except:
-            model = torch.nn.DataParallel(model)
-            model.load_state_dict(
-                torch.load(model_path, map_location=torch.device("cpu"))
-            )
+    model.load_state_dict(state_dict)
+    return model
+
+
+def load_model(model_path):
+    return model_to_device(load_weights(model_path))
+
+
+def get_cached_model(model_path):
+    """Return the model for model_path, loading it only if it is not cached"""
+    key = (os.path.abspath(model_path), os.path.getmtime(model_path))
+    with _cache_lock:
+        if key in _model_cache:
+            _model_cache.move_to_end(key)
+            return _model_cache[key]
+        # any entry for this path with a different mtime is out of date.
+        invalidate_model_cache(model_path)
+        model = load_model(model_path)
+        _model_cache[key] = model
+        while len(_model_cache) > model_cache_size:
+            _model_cache.popitem(last=False)
+        return model
+
+
+def invalidate_model_cache(model_path=None):
+    """Remove model_path from the model cache, or everything if None"""
+    with _cache_lock:
+        if model_path is None:
+            _model_cache.clear()
+            _engine_cache.clear()
+            return
+        abs_path = os.path.abspath(model_path)
+        for cache in (_model_cache, _engine_cache):
+            for key in [k for k in cache if k[0] == abs_path]:
+                del cache[key]
+
+
+def get_state_dict_snapshot(model):
+    """
+    Copy of the weights of model, left on the device, that doesn't change
+    as model is trained further. Keys don't have the DataParallel prefix.
+    """
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    with torch.no_grad():
+        return {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+
+def model_from_state_dict(state_dict, model=None):
+    """
+    Model on the device with the weights from state_dict (see
+    get_state_dict_snapshot). If model is given, it is reused rather
+    than creating a new one.
+    """
+    if model is None:
+        model = model_to_device(UNetGNRes())
+    module = model.module if isinstance(model, torch.nn.DataParallel) else model
+    module.load_state_dict(state_dict)
     return model
 
 
+class TorchEngine:
+    """
+    Run a torch model on batches of tiles for segmentation.
+
+    mode is 'eager' to run the model as it is, 'torchscript' to run a frozen
+    TorchScript trace of it or 'compile' to run it with torch.compile.
+    Traced and compiled modules are built (and warmed up) for batches of bs
+    in_w tiles, so smaller batches are padded to bs. They run on a single
+    device, without DataParallel. If building fails the model is run as
+    it is instead.
+    """
+
+    def __init__(self, model, mode="eager", bs=None, in_w=None):
+        self.module = model
+        self.mode = "eager"
+        self.bs = bs
+        if mode != "eager":
+            try:
+                self.module = self.build(model, mode, bs, in_w)
+                self.mode = mode
+            except Exception as e:
+                print(f"Could not build {mode} model, running it eagerly.", e)
+
+    @staticmethod
+    def build(model, mode, bs, in_w):
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        model.eval()
+        example = to_device(torch.zeros((bs, 3, in_w, in_w)))
+        with torch.no_grad(), autocast():
+            if mode == "torchscript":
+                module = torch.jit.freeze(torch.jit.trace(model, example))
+            elif mode == "compile":
+                module = torch.compile(model, dynamic=False)
+            else:
+                raise ValueError(f"Unknown mode {mode}")
+            # The first runs are slow as they optimise the module,
+            # so do them now rather than when segmenting.
+            for _ in range(2):
+                module(example)
+        return module
+
+    @property
+    def device(self):
+        return device
+
+    def predict(self, batch):
+        """foreground probabilities for {batch}, a float32 NCHW numpy array"""
+        batch = to_device(torch.from_numpy(batch))
+        return self.predict_tensor(batch).cpu().numpy()
+
+    def predict_tensor(self, batch):
+        """foreground probabilities for {batch}, a tensor on self.device"""
+        batch_size = len(batch)
+        with torch.inference_mode():
+            if self.mode != "eager" and batch_size < self.bs:
+                padding = batch.new_zeros((self.bs - batch_size,) + batch.shape[1:])
+                batch = torch.cat([batch, padding])
+            with autocast():
+                outputs = self.module(batch)
+            softmaxed = softmax(outputs[:batch_size].float(), 1)
+            # just the foreground probability.
+            return softmaxed[:, 1]
+
+
+def load_torch_engine(model_path, in_w, bs, mode):
+    model = get_cached_model(model_path)
+    if isinstance(model, torch.nn.DataParallel) and len(model.device_ids) > 1:
+        # Spreading batches over the GPUs is faster than a single
+        # device engine.
+        mode = "eager"
+    return TorchEngine(model, mode, bs, in_w)
+
+
+def get_derived_model_path(model_path, suffix):
+    """
+    Path in derived_model_dir for a file made from the checkpoint at
+    model_path. The name includes the checkpoint mtime so a replaced
+    checkpoint gets a new file.
+    """
+    os.makedirs(derived_model_dir, exist_ok=True)
+    abs_path = os.path.abspath(model_path)
+    key = hashlib.sha1(abs_path.encode("utf-8")).hexdigest()[:16]
+    name, _ = os.path.splitext(os.path.basename(model_path))
+    mtime = os.stat(model_path).st_mtime_ns
+    return os.path.join(derived_model_dir, f"{name}_{key}_{mtime}{suffix}")
+
+
+def export_onnx(model_path, onnx_path=None, in_w=572):
+    """
+    Export the checkpoint at model_path to ONNX, with a dynamic batch size.
+    onnx_path defaults to a path in derived_model_dir.
+    Returns the path of the exported model.
+    """
+    if onnx_path is None:
+        onnx_path = get_derived_model_path(model_path, ".onnx")
+    model = load_weights(model_path, map_location="cpu")
+    model.eval()
+    example = torch.zeros((1, 3, in_w, in_w))
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # newer versions of torch default to the dynamo exporter
+        # which needs extra packages.
+        kwargs["dynamo"] = False
+    # export to a temporary file so a partly written model is never loaded.
+    temp_path = f"{onnx_path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            example,
+            temp_path,
+            input_names=["tiles"],
+            output_names=["outputs"],
+            dynamic_axes={"tiles": {0: "batch"}, "outputs": {0: "batch"}},
+            opset_version=13,
+            **kwargs,
+        )
+    os.replace(temp_path, onnx_path)
+    return onnx_path
+
+
+class OnnxEngine:
+    """
+    Run an exported model (see export_onnx) with the ONNX Runtime CPU
+    execution provider. Needs the onnxruntime package.
+    """
+
+    def __init__(self, onnx_path, num_threads=None):
+        try:
+            import onnxruntime  # pylint: disable=C0415
+        except ImportError as e:
+            raise ImportError(
+                "The onnx backend needs onnxruntime, pip install onnxruntime"
+            ) from e
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, options, providers=["CPUExecutionProvider"]
+        )
+
+    device = torch.device("cpu")
+
+    def predict(self, batch):
+        """foreground probabilities for {batch}, a float32 NCHW numpy array"""
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        outputs = self.session.run(None, {"tiles": batch})[0]
+        # softmax of two classes is the sigmoid of their difference.
+        return 1 / (1 + np.exp(outputs[:, 0] - outputs[:, 1]))
+
+    def predict_tensor(self, batch):
+        """foreground probabilities for {batch}, a CPU tensor"""
+        return torch.from_numpy(self.predict(batch.numpy()))
+
+
+def load_onnx_engine(model_path, in_w, _bs):
+    """OnnxEngine for model_path, exporting it first if needed"""
+    onnx_path = get_derived_model_path(model_path, ".onnx")
+    if not os.path.isfile(onnx_path):
+        export_onnx(model_path, onnx_path, in_w)
+    return OnnxEngine(onnx_path)
+
+
+def get_calibration_batch(data_dir, in_w, num_tiles=32, max_images=8):
+    """
+    Batch of random in_w tiles from (up to max_images of) the images in
+    data_dir, normalised as they are for segmentation.
+    """
+    fnames = [f for f in ls(data_dir) if im_utils.is_photo(f)]
+    fnames = random.sample(fnames, min(max_images, len(fnames)))
+    assert fnames, f"No images in {data_dir} for calibration"
+    images = [im_utils.load_image(os.path.join(data_dir, f)) for f in fnames]
+    tiles = []
+    for i in range(num_tiles):
+        image, _ = im_utils.pad_to_min(images[i % len(images)], min_w=in_w, min_h=in_w)
+        y = random.randint(0, image.shape[0] - in_w)
+        x = random.randint(0, image.shape[1] - in_w)
+        tiles.append(image[y : y + in_w, x : x + in_w])
+    return torch.from_numpy(im_utils.tiles_to_batch(tiles))
+
+
+def quantize_model(model_path, data_dir, in_w=572, quantized_path=None, bs=4):
+    """
+    Post-training static int8 quantization of the checkpoint at model_path,
+    calibrated on tiles from the images in data_dir (the project dataset).
+    The quantized model is saved as TorchScript to quantized_path,
+    which defaults to a path in derived_model_dir.
+    Returns the path of the quantized model.
+
+    Quantized models only run on CPU.
+    """
+    # pylint: disable=C0415
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    if quantized_path is None:
+        quantized_path = get_derived_model_path(model_path, f"_int8_{in_w}.pt")
+    model = load_weights(model_path, map_location="cpu")
+    model.eval()
+    batch = get_calibration_batch(data_dir, in_w)
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(model, qconfig_mapping, (batch[:1],))
+    with torch.no_grad():
+        # observe the range of values at each layer.
+        for i in range(0, len(batch), bs):
+            prepared(batch[i : i + bs])
+        quantized = convert_fx(prepared)
+        traced = torch.jit.trace(quantized, batch[:1])
+    temp_path = f"{quantized_path}.{os.getpid()}.tmp"
+    torch.jit.save(traced, temp_path)
+    os.replace(temp_path, quantized_path)
+    return quantized_path
+
+
+def ensure_quantized(model_path, data_dir, in_w=572):
+    """Path of the int8 model for model_path, quantizing it if needed"""
+    quantized_path = get_derived_model_path(model_path, f"_int8_{in_w}.pt")
+    if not os.path.isfile(quantized_path):
+        print("Quantizing", model_path, "calibrated on", data_dir)
+        quantize_model(model_path, data_dir, in_w, quantized_path)
+    return quantized_path
+
+
+class QuantizedEngine:
+    """Run an int8 model made by quantize_model, on CPU"""
+
+    def __init__(self, quantized_path):
+        self.module = torch.jit.load(quantized_path, map_location="cpu")
+        self.module.eval()
+
+    device = torch.device("cpu")
+
+    def predict(self, batch):
+        """foreground probabilities for {batch}, a float32 NCHW numpy array"""
+        return self.predict_tensor(torch.from_numpy(batch)).numpy()
+
+    def predict_tensor(self, batch):
+        """foreground probabilities for {batch}, a CPU tensor"""
+        with torch.inference_mode():
+            outputs = self.module(batch.contiguous())
+            softmaxed = softmax(outputs.float(), 1)
+            return softmaxed[:, 1]
+
+
+def load_int8_engine(model_path, in_w, _bs):
+    quantized_path = get_derived_model_path(model_path, f"_int8_{in_w}.pt")
+    if not os.path.isfile(quantized_path):
+        raise FileNotFoundError(
+            f"No int8 model for {model_path}, quantize it with ensure_quantized"
+        )
+    return QuantizedEngine(quantized_path)
+
+
+def quantization_report(model_path, val_annot_dir, dataset_dir, in_w, out_w, bs):
+    """
+    Compare the int8 model for model_path with the float32 model on the
+    validation annotations, giving the speedup and the change in F1.
+    """
+    ensure_quantized(model_path, dataset_dir, in_w)
+    fp32 = get_inference_engine(model_path, in_w, bs, "eager")
+    int8 = get_inference_engine(model_path, in_w, bs, "int8")
+    fp32_metrics = get_val_metrics(fp32, val_annot_dir, dataset_dir, in_w, out_w, bs)
+    int8_metrics = get_val_metrics(int8, val_annot_dir, dataset_dir, in_w, out_w, bs)
+    return {
+        "fp32_f1": fp32_metrics["f1"],
+        "int8_f1": int8_metrics["f1"],
+        "f1_drift": int8_metrics["f1"] - fp32_metrics["f1"],
+        "fp32_duration": fp32_metrics["duration"],
+        "int8_duration": int8_metrics["duration"],
+        "speedup": fp32_metrics["duration"] / int8_metrics["duration"],
+    }
+
+
+# Ways of running a checkpoint for segmentation, each a function
+# of (model_path, in_w, bs) which returns an object with a predict method.
+inference_backends = {
+    "eager": partial(load_torch_engine, mode="eager"),
+    "torchscript": partial(load_torch_engine, mode="torchscript"),
+    "compile": partial(load_torch_engine, mode="compile"),
+    "onnx": load_onnx_engine,
+    # needs ensure_quantized to be called first, which calibrates on a dataset.
+    "int8": load_int8_engine,
+}
+default_backend = "torchscript"
+
+
+def get_inference_engine(model_path, in_w, bs, backend=None):
+    """
+    Return the inference engine for model_path from {backend}, building it
+    only if it is not cached. Engines are kept between segment instructions
+    so the cost of building them is only paid once per checkpoint.
+    """
+    backend = backend or default_backend
+    if backend not in inference_backends:
+        raise ValueError(
+            f"Unknown backend {backend}, available: {list(inference_backends)}"
+        )
+    key = (
+        os.path.abspath(model_path),
+        os.path.getmtime(model_path),
+        in_w,
+        bs,
+        backend,
+        precision,
+        str(device),
+    )
+    with _cache_lock:
+        if key in _engine_cache:
+            _engine_cache.move_to_end(key)
+            return _engine_cache[key]
+        engine = inference_backends[backend](model_path, in_w, bs)
+        _engine_cache[key] = engine
+        while len(_engine_cache) > model_cache_size:
+            _engine_cache.popitem(last=False)
+        return engine
+
+
 def create_first_model_with_random_weights(model_dir):
     # used when no model was specified on project creation.
     model_num = 1
@@ -83,38 +558,129 @@ def create_first_model_with_random_weights(model_dir):
     model = torch.nn.DataParallel(model)
     model_path = os.path.join(model_dir, model_name)
     torch.save(model.state_dict(), model_path)
+    return model_to_device(model.module)
 
-    if torch.cuda.is_available():
-        model.cuda()
-    return model
+
+def empty_cache():
+    """return memory held by the torch allocator to the device"""
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def training_step_fits(model, optimizer, bs, in_w, out_w, with_validation=False):
+    """
+    True if a training step with a batch of bs tiles fits in device memory.
+
+    If with_validation then room is also left for validation running at
+    the same time (see Trainer.validation), which holds a copy of the
+    weights for the model it validates and a snapshot of them, and runs
+    batches of bs tiles through it.
+    """
+    scaler = get_grad_scaler()
+    try:
+        photos = to_device(torch.rand(bs, 3, in_w, in_w))
+        labels = torch.randint(0, 2, (bs, out_w, out_w), device=device)
+        optimizer.zero_grad(set_to_none=True)
+        with autocast():
+            outputs = model(photos)
+        if with_validation:
+            # whilst the activations of the training forward pass are held.
+            copies = [get_state_dict_snapshot(model) for _ in range(2)]
+            with torch.no_grad(), autocast():
+                model(photos)
+            del copies
+        loss = criterion(outputs.float(), labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return True
+    except RuntimeError as error:
+        # torch.cuda.OutOfMemoryError is a RuntimeError
+        if "out of memory" not in str(error).lower():
+            raise
+        return False
+    finally:
+        optimizer.zero_grad(set_to_none=True)
+
+
+def find_batch_size(in_w, out_w, max_bs=12, with_validation=False):
+    """
+    Largest batch size, up to max_bs, for which a training step (forward,
+    backward and optimizer step) with in_w tiles fits in device memory,
+    along with validation if with_validation (see training_step_fits).
+    """
+    model = model_to_device(UNetGNRes())
+    bs = search_batch_size(model, in_w, out_w, max_bs, with_validation)
+    del model
+    # the network used for the search has been freed by now.
+    empty_cache()
+    return bs
+
+
+def search_batch_size(model, in_w, out_w, max_bs, with_validation=False):
+    """
+    The batch size is doubled until a training step of model runs out
+    of memory and then the largest that fits is found by bisection.
+    """
+    model.train()
+    optimizer = torch.optim.SGD(
+        model.parameters(), lr=0.01, momentum=0.99, nesterov=True
+    )
+
+    def fits(bs):
+        result = training_step_fits(model, optimizer, bs, in_w, out_w, with_validation)
+        empty_cache()
+        return result
+
+    good, bad = 0, None
+    bs = 1
+    while good < max_bs:
+        if not fits(bs):
+            bad = bs
+            break
+        good = bs
+        bs = min(bs * 2, max_bs)
+    while bad is not None and bad - good > 1:
+        bs = (good + bad) // 2
+        if fits(bs):
+            good = bs
+        else:
+            bad = bs
+    # if even a single tile doesn't fit then training will report the error.
+    return max(1, good)
 
 
 def get_prev_model(model_dir):
     prev_path = get_latest_model_paths(model_dir, k=1)[0]
-    prev_model = load_model(prev_path)
+    prev_model = get_cached_model(prev_path)
     return prev_model, prev_path
 
 
-def get_val_metrics(cnn, val_annot_dir, dataset_dir, in_w, out_w, bs):
+def get_val_metrics(
+    cnn, val_annot_dir, dataset_dir, in_w, out_w, bs, defined_only=True
+):
     """
     Return the TP, FP, TN, FN, defined_sum, duration
     for the {cnn} on the validation set
 
+    {cnn} can also be a model path, in which case the model
+    is taken from the model cache.
+
+    If {defined_only} is True then only the tiles which have some
+    annotation defined are segmented. As metrics are only computed
+    where annotation is defined the result is the same as segmenting
+    the full image.
+
     TODO - This is too similar to the train loop. Merge both and use flags.
     """
     start = time.time()
+    if isinstance(cnn, str):
+        cnn = get_cached_model(cnn)
     fnames = ls(val_annot_dir)
     fnames = [a for a in fnames if im_utils.is_photo(a)]
-    # TODO: In order to speed things up, be a bit smarter here
-    # by only segmenting the parts of the image where we have
-    # some annotation defined.
-    # implement a 'partial segment' which excludes tiles with no
-    # annotation defined.
-    tps = 0
-    fps = 0
-    tns = 0
-    fns = 0
-    defined_sum = 0
+    metrics = MetricAccumulator()
     for fname in fnames:
         annot_path = os.path.join(val_annot_dir, os.path.splitext(fname)[0] + ".png")
         # reading the image may throw an exception.
@@ -143,26 +709,29 @@ def get_val_metrics(cnn, val_annot_dir, dataset_dir, in_w, out_w, bs):
 
         image_path = glob.glob(image_path_part + ".*")[0]
         image = im_utils.load_image(image_path)
-        image, pad_settings = im_utils.pad_to_min(image, min_w=572, min_h=572)
-        predicted = unet_segment(cnn, image, bs, in_w, out_w, threshold=0.5)
-        predicted = im_utils.crop_from_pad_settings(predicted, pad_settings)
 
         # mask defines which pixels are defined in the annotation.
         mask = foreground + background
         mask = mask.astype(bool).astype(int)
-        predicted *= mask
-        predicted = predicted.astype(bool).astype(int)
-        y_defined = mask.reshape(-1)
-        y_pred = predicted.reshape(-1)[y_defined > 0]
-        y_true = foreground.reshape(-1)[y_defined > 0]
-        tps += np.sum(np.logical_and(y_pred == 1, y_true == 1))
-        tns += np.sum(np.logical_and(y_pred == 0, y_true == 0))
-        fps += np.sum(np.logical_and(y_pred == 1, y_true == 0))
-        fns += np.sum(np.logical_and(y_pred == 0, y_true == 1))
-        defined_sum += np.sum(y_defined > 0)
+
+        image, pad_settings = im_utils.pad_to_min(image, min_w=572, min_h=572)
+        defined = None
+        if defined_only:
+            # padding is never defined.
+            defined = np.pad(mask, pad_settings[:2], mode="constant")
+        predicted = unet_segment(
+            cnn, image, bs, in_w, out_w, threshold=0.5, defined=defined
+        )
+        predicted = im_utils.crop_from_pad_settings(predicted, pad_settings)
+        predicted = predicted * mask
+        predicted = predicted.astype(bool)
+        metrics.add(
+            torch.from_numpy(predicted),
+            torch.from_numpy(foreground),
+            torch.from_numpy(mask),
+        )
     duration = round(time.time() - start, 3)
-    metrics = get_metrics(tps, fps, tns, fns, defined_sum, duration)
-    return metrics
+    return metrics.get_metrics(duration)
 
 
 def save_if_better(model_dir, cur_model, prev_model_path, cur_f1, prev_f1):
@@ -181,54 +750,184 @@ def save_if_better(model_dir, cur_model, prev_model_path, cur_f1, prev_f1):
         model_path = os.path.join(model_dir, model_name)
         print("saving", model_path, time.strftime("%H:%M:%S", time.localtime(now)))
         torch.save(cur_model.state_dict(), model_path)
+        # make sure a model cached under this path is not used in place
+        # of the checkpoint that was just written.
+        invalidate_model_cache(model_path)
         return True
     return False
 
 
-def ensemble_segment(model_paths, image, bs, in_w, out_w, threshold=0.5):
+class EnsembleEngine:
+    """
+    Average the foreground probabilities from several engines, each run
+    on the tiles and their horizontal flips (test time augmentation).
+
+    The batch is copied to the device once. The flipped tiles are made on
+    the device and go in the same batch as the originals, so each engine
+    runs on twice the number of tiles in the batch.
+    """
+
+    def __init__(self, engines):
+        self.engines = engines
+
+    def predict(self, batch):
+        """foreground probabilities for {batch}, a float32 NCHW numpy array"""
+        batch = torch.from_numpy(batch)
+        if self.engines[0].device == device:
+            batch = to_device(batch)
+        batch_size = len(batch)
+        with torch.inference_mode():
+            batch = torch.cat([batch, torch.flip(batch, [3])])
+            prob_sum = None
+            for engine in self.engines:
+                probs = engine.predict_tensor(batch)
+                if prob_sum is None:
+                    prob_sum = probs.clone()
+                else:
+                    prob_sum.add_(probs)
+            # flip the predictions for the flipped tiles back.
+            prob_sum = prob_sum[:batch_size].add_(
+                torch.flip(prob_sum[batch_size:], [2])
+            )
+            prob_sum.div_(len(self.engines) * 2)
+            return prob_sum.cpu().numpy()
+
+
+def ensemble_segment(model_paths, image, bs, in_w, out_w, threshold=0.5, backend=None):
     """Average predictions from each model specified in model_paths"""
-    pred_sum = None
-    pred_count = 0
-    image, pad_settings = im_utils.pad_to_min(image, min_w=in_w, min_h=in_w)
-    # then add predictions from the previous models to form an ensemble
-    for model_path in model_paths:
-        cnn = load_model(model_path)
-        preds = unet_segment(cnn, image, bs, in_w, out_w, threshold=None)
-        if pred_sum is not None:
-            pred_sum += preds
-        else:
-            pred_sum = preds
-        pred_count += 1
-        # get flipped version too (test time augmentation)
-        flipped_im = np.fliplr(image)
-        flipped_pred = unet_segment(cnn, flipped_im, bs, in_w, out_w, threshold=None)
-        pred_sum += np.fliplr(flipped_pred)
-        pred_count += 1
-    pred_sum = im_utils.crop_from_pad_settings(pred_sum, pad_settings)
-    foreground_probs = pred_sum / pred_count
-    predicted = foreground_probs > threshold
-    predicted = predicted.astype(int)
+    images = [(None, image)]
+    _, predicted = next(
+        ensemble_segment_images(
+            model_paths, images, bs, in_w, out_w, threshold, backend
+        )
+    )
     return predicted
 
 
-def epoch(model, train_loader, batch_size, optimizer, step_callback, stop_fn):
-    """One training epoch"""
+def ensemble_segment_images(
+    model_paths, images, bs, in_w, out_w, threshold=0.5, backend=None
+):
+    """
+    Segment each image from {images}, an iterable of (key, image) pairs,
+    using an ensemble of the models in {model_paths}, run with the
+    inference {backend} (see inference_backends).
+    Yields (key, predicted) pairs in the same order as {images}.
+
+    Tiles from consecutive images are segmented together so batches
+    are full even when each image only gives a few tiles. Each batch
+    holds bs // 2 tiles and their flipped copies (see EnsembleEngine).
+    """
+    group = []
+    group_tile_count = 0
+    for key, image in images:
+        image, pad_settings = im_utils.pad_to_min(image, min_w=in_w, min_h=in_w)
+        tiles, coords = im_utils.get_tiles(
+            image, in_tile_shape=(in_w, in_w, 3), out_tile_shape=(out_w, out_w)
+        )
+        group_tile_count += len(tiles)
+        group.append((key, image.shape[:-1], pad_settings, tiles, coords))
+        if group_tile_count >= max(1, bs // 2):
+            yield from ensemble_segment_group(
+                model_paths, group, bs, in_w, out_w, threshold, backend
+            )
+            group = []
+            group_tile_count = 0
+    if group:
+        yield from ensemble_segment_group(
+            model_paths, group, bs, in_w, out_w, threshold, backend
+        )
+
+
+def ensemble_segment_bands(
+    model_paths, read_rows, height, bs, in_w, out_w, band_h, threshold=0.5, backend=None
+):
+    """
+    Segment an image one horizontal band of {band_h} rows at a time,
+    yielding the predicted rows of each band in order.
+    {read_rows}(top, bottom) should return those rows of the image.
+
+    Each band is read with the (in_w - out_w) // 2 rows of context above and
+    below that the network uses so bands join up without visible seams.
+    """
+    context = (in_w - out_w) // 2
+    for top in range(0, height, band_h):
+        bottom = min(top + band_h, height)
+        read_top = max(0, top - context)
+        read_bottom = min(height, bottom + context)
+        band = read_rows(read_top, read_bottom)
+        predicted = ensemble_segment(
+            model_paths, band, bs, in_w, out_w, threshold, backend
+        )
+        yield predicted[top - read_top : bottom - read_top]
+
+
+def ensemble_segment_group(model_paths, group, bs, in_w, out_w, threshold, backend):
+    """
+    Segment the tiles from a group of images prepared by
+    ensemble_segment_images and yield (key, predicted) for each image.
+    Threshold set to None means probabilities returned without thresholding.
+    """
+    tiles = []
+    for _, _, _, image_tiles, _ in group:
+        tiles += image_tiles
+    # each tile is run with its flipped copy, so only half as many fit.
+    tiles_per_batch = max(1, bs // 2)
+    engines = [
+        get_inference_engine(model_path, in_w, tiles_per_batch * 2, backend)
+        for model_path in model_paths
+    ]
+    output_tiles = segment_tiles(
+        EnsembleEngine(engines), tiles, tiles_per_batch, out_w, threshold=None
+    )
+    # route each output tile back to the image it came from.
+    for key, shape, pad_settings, image_tiles, coords in group:
+        image_output = islice(output_tiles, len(image_tiles))
+        foreground_probs = im_utils.reconstruct_from_tiles(image_output, coords, shape)
+        foreground_probs = im_utils.crop_from_pad_settings(
+            foreground_probs, pad_settings
+        )
+        if threshold is None:
+            yield key, foreground_probs
+            continue
+        predicted = foreground_probs > threshold
+        predicted = predicted.astype(int)
+        yield key, predicted
+
+
+def epoch(
+    model,
+    train_loader,
+    batch_size,
+    optimizer,
+    step_callback,
+    stop_fn,
+    print_interval=20,
+    scaler=None,
+):
+    """
+    One training epoch
+    Progress is printed every print_interval steps, as reading the
+    loss waits for the device to finish.
+    {scaler} is the GradScaler to use with mixed precision, kept between
+    epochs by the caller. One is created if not specified.
+    """
 
     model.to(device)
     model.train()
-    tps = 0
-    fps = 0
-    tns = 0
-    fns = 0
-    defined_total = 0
+    metrics = MetricAccumulator()
+    if scaler is None:
+        scaler = get_grad_scaler()
 
     for step, (photo_tiles, foreground_tiles, defined_tiles) in enumerate(train_loader):
-        photo_tiles = photo_tiles.to(device)
+        photo_tiles = to_device(photo_tiles)
         foreground_tiles = foreground_tiles.to(device).float()
         defined_tiles = defined_tiles.to(device)
         optimizer.zero_grad()
 
-        outputs = model(photo_tiles)
+        with autocast():
+            outputs = model(photo_tiles)
+        # the loss sums over many pixels so is computed in float32.
+        outputs = outputs.float()
         softmaxed = softmax(outputs, 1)
 
         # just the foreground probability. (remove soon)
@@ -239,8 +938,9 @@ def epoch(model, train_loader, batch_size, optimizer, step_callback, stop_fn):
 
         loss = criterion(outputs, foreground_tiles.long())
 
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         if step_callback:
             step_callback()
@@ -256,32 +956,32 @@ def epoch(model, train_loader, batch_size, optimizer, step_callback, stop_fn):
         # so remove all predictions and foreground labels where
         # we didn't have any annotation.
 
-        defined_list = defined_tiles.reshape(-1)
-        preds_list = foreground_probs.reshape(-1)[defined_list > 0] > 0.5
-        foregrounds_list = foreground_tiles.reshape(-1)[defined_list > 0]
-
-        # # calculate all the false positives, false negatives etc
-        tps += torch.sum((foregrounds_list == 1) * (preds_list == 1)).cpu().numpy()
-        tns += torch.sum((foregrounds_list == 0) * (preds_list == 0)).cpu().numpy()
-        fps += torch.sum((foregrounds_list == 0) * (preds_list == 1)).cpu().numpy()
-        fns += torch.sum((foregrounds_list == 1) * (preds_list == 0)).cpu().numpy()
-        defined_total += torch.sum(defined_list > 0).cpu().numpy()
-        # https://github.com/googlecolab/colabtools/issues/166
-        print(
-            f"\rTraining: {(step + 1) * batch_size}/"
-            f"{len(train_loader.dataset)} "
-            f" loss={round(loss.item(), 3)}",
-            end="",
-            flush=True,
+        metrics.add(
+            foreground_probs.detach() > 0.5, foreground_tiles, defined_tiles, loss
         )
+        if step % print_interval == 0:
+            # https://github.com/googlecolab/colabtools/issues/166
+            print(
+                f"\rTraining: {(step + 1) * batch_size}/"
+                f"{len(train_loader.dataset)} "
+                f" loss={round(loss.item(), 3)}",
+                end="",
+                flush=True,
+            )
         if stop_fn and stop_fn():
             return None
+    tps, fps, tns, fns, defined_total, _ = metrics.values()
     return (tps, fps, tns, fns, defined_total)
 
 
-def unet_segment(cnn, image, bs, in_w, out_w, threshold=0.5):
+def unet_segment(cnn, image, bs, in_w, out_w, threshold=0.5, defined=None):
     """
     Threshold set to None means probabilities returned without thresholding.
+    {cnn} is a torch model or an inference engine (see get_inference_engine).
+
+    If {defined} is specified (a mask the same size as image) then only
+    tiles with output overlapping the defined region are segmented and the
+    output is left as 0 everywhere else.
     """
     assert image.shape[0] >= in_w, str(image.shape[0])
     assert image.shape[1] >= in_w, str(image.shape[1])
@@ -289,43 +989,37 @@ def unet_segment(cnn, image, bs, in_w, out_w, threshold=0.5):
     tiles, coords = im_utils.get_tiles(
         image, in_tile_shape=(in_w, in_w, 3), out_tile_shape=(out_w, out_w)
     )
-    tile_idx = 0
-    batches = []
-    while tile_idx < len(tiles):
-        tiles_to_process = []
-        for _ in range(bs):
-            if tile_idx < len(tiles):
-                tile = tiles[tile_idx]
-                tile = img_as_float32(tile)
-                tile = im_utils.normalize_tile(tile)
-                tile = np.moveaxis(tile, -1, 0)
-                tile_idx += 1
-                tiles_to_process.append(tile)
-        tiles_for_gpu = torch.from_numpy(np.array(tiles_to_process))
-        if torch.cuda.is_available():
-            tiles_for_gpu.cuda()
-        tiles_for_gpu = tiles_for_gpu.float()
-        batches.append(tiles_for_gpu)
-
-    output_tiles = []
-    for gpu_tiles in batches:
-        outputs = cnn(gpu_tiles.cuda())
-        softmaxed = softmax(outputs, 1)
-        foreground_probs = softmaxed[:, 1, :]  # just the foreground probability.
-        if threshold is not None:
-            predicted = foreground_probs > threshold
-            predicted = predicted.view(-1).int()
-        else:
-            predicted = foreground_probs
-
-        pred_np = predicted.data.cpu().numpy()
-        out_tiles = pred_np.reshape((len(gpu_tiles), out_w, out_w))
-        for out_tile in out_tiles:
-            output_tiles.append(out_tile)
+    if defined is not None:
+        # The last tile written to a pixel is the one that sets its value.
+        # Any tile covering a defined pixel is kept, so defined pixels
+        # get exactly the same output as a full segmentation.
+        keep = [
+            i
+            for i, (x, y) in enumerate(coords)
+            if np.any(defined[y : y + out_w, x : x + out_w])
+        ]
+        tiles = [tiles[i] for i in keep]
+        coords = [coords[i] for i in keep]
+    output_tiles = segment_tiles(cnn, tiles, bs, out_w, threshold)
+    dtype = np.float32 if threshold is None else np.uint8
+    return im_utils.reconstruct_from_tiles(
+        output_tiles, coords, image.shape[:-1], dtype=dtype
+    )
 
-    assert len(output_tiles) == len(coords), f"{len(output_tiles)} {len(coords)}"
 
-    reconstructed = im_utils.reconstruct_from_tiles(
-        output_tiles, coords, image.shape[:-1]
-    )
-    return reconstructed
+def segment_tiles(cnn, tiles, bs, out_w, threshold=0.5):
+    """
+    Segment {tiles} in batches of {bs} and yield each output tile.
+    Threshold set to None means probabilities returned without thresholding.
+    {cnn} is a torch model or an inference engine (see get_inference_engine).
+    """
+    if not hasattr(cnn, "predict"):
+        cnn = TorchEngine(cnn)
+    batch = None
+    for batch_start in range(0, len(tiles), bs):
+        # the batch array from the first (largest) batch is reused.
+        batch = im_utils.tiles_to_batch(tiles[batch_start : batch_start + bs], batch)
+        foreground_probs = cnn.predict(batch)
+        if threshold is not None:
+            foreground_probs = foreground_probs > threshold
+        yield from foreground_probs.reshape((len(batch), out_w, out_w))
@@ -0,0 +1,188 @@
+"""
+Foreground probability maps saved when segmenting, so a segmentation
+can be thresholded again without running the network.
+
+Copyright (C) 2020 Abraham George Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# pylint: disable=C0111
+import os
+import io
+import zipfile
+
+import numpy as np
+
+from root_painter_trainer.im_utils import move_into_place
+
+# segment instruction format -> (file extension, stored type)
+# .npy files can be memory-mapped. .npz files are compressed and split
+# into bands of rows (chunks) so part of the map can be read on its own.
+# uint8 maps store round(probability * 255).
+prob_formats = {
+    "Probability uint8 (.npy)": (".npy", np.uint8),
+    "Probability float16 (.npy)": (".npy", np.float16),
+    "Probability Compressed (.npz)": (".npz", np.uint8),
+}
+
+
+def to_stored(probs, dtype):
+    if dtype == np.uint8:
+        return np.round(probs * 255).astype(np.uint8)
+    return probs.astype(dtype)
+
+
+def from_stored(stored):
+    if stored.dtype == np.uint8:
+        return stored.astype(np.float32) / 255
+    return stored.astype(np.float32)
+
+
+class ProbMapWriter:
+    """
+    Write a probability map in one of prob_formats
+    a band of rows at a time.
+    """
+
+    def __init__(self, path, width, height, format_str, chunk_rows=256):
+        self.ext, self.dtype = prob_formats[format_str]
+        self.chunk_rows = chunk_rows
+        self.top = 0
+        if self.ext == ".npy":
+            self.array = np.lib.format.open_memmap(
+                path, mode="w+", dtype=self.dtype, shape=(height, width)
+            )
+        else:
+            self.zip_file = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            self.write_member("shape", np.array([height, width, chunk_rows]))
+            # rows waiting to fill a chunk, which starts at chunk_top.
+            self.pending = []
+            self.pending_count = 0
+            self.chunk_top = 0
+
+    def write_rows(self, probs):
+        """write the next rows of foreground probabilities"""
+        stored = to_stored(probs, self.dtype)
+        if self.ext == ".npy":
+            self.array[self.top : self.top + len(stored)] = stored
+        else:
+            self.pending.append(stored)
+            self.pending_count += len(stored)
+            if self.pending_count >= self.chunk_rows:
+                self.write_chunks()
+        self.top += len(stored)
+
+    def write_chunks(self, final=False):
+        """write the pending rows as chunks of chunk_rows, keeping
+        the rows left over for the next chunk unless final"""
+        rows = np.concatenate(self.pending)
+        start = 0
+        while len(rows) - start >= self.chunk_rows or (final and start < len(rows)):
+            chunk = rows[start : start + self.chunk_rows]
+            self.write_member(f"rows_{self.chunk_top:09d}", chunk)
+            self.chunk_top += len(chunk)
+            start += len(chunk)
+        self.pending = [rows[start:]]
+        self.pending_count = len(rows) - start
+
+    def write_member(self, name, array):
+        with self.zip_file.open(name + ".npy", "w", force_zip64=True) as member:
+            np.save(member, array)
+
+    def close(self):
+        if self.ext == ".npy":
+            self.array.flush()
+            del self.array
+        else:
+            if self.pending_count:
+                self.write_chunks(final=True)
+            self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ProbMapReader:
+    """Read rows of a probability map saved by ProbMapWriter"""
+
+    def __init__(self, path):
+        if path.endswith(".npy"):
+            self.array = np.load(path, mmap_mode="r")
+            self.height, self.width = self.array.shape
+            self.zip_file = None
+        else:
+            self.zip_file = zipfile.ZipFile(path, "r")
+            self.height, self.width, self.chunk_rows = self.read_member("shape")
+            self.chunk = (None, None)  # (top, rows) of the last chunk read
+
+    def read_member(self, name):
+        return np.load(io.BytesIO(self.zip_file.read(name + ".npy")))
+
+    def read(self, top, bottom):
+        """foreground probabilities (float32) of rows top to bottom"""
+        if self.zip_file is None:
+            return from_stored(np.asarray(self.array[top:bottom]))
+        bands = []
+        chunk_top = (top // self.chunk_rows) * self.chunk_rows
+        while chunk_top < bottom:
+            if self.chunk[0] != chunk_top:
+                self.chunk = (chunk_top, self.read_member(f"rows_{chunk_top:09d}"))
+            rows = self.chunk[1]
+            bands.append(rows[max(0, top - chunk_top) : bottom - chunk_top])
+            chunk_top += self.chunk_rows
+        return from_stored(np.concatenate(bands))
+
+    def bands(self, band_rows=1024):
+        """yield (top, probabilities) for each band of band_rows rows"""
+        for top in range(0, self.height, band_rows):
+            yield top, self.read(top, min(top + band_rows, self.height))
+
+    def close(self):
+        if self.zip_file is None:
+            del self.array
+        else:
+            self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def save_prob_map(out_path, probs, format_str):
+    """Save probs to out_path, via a temporary file (see save_then_move)"""
+    fname = os.path.basename(out_path)
+    temp_path = os.path.join(os.path.dirname(out_path), ".tmp." + fname)
+    with ProbMapWriter(temp_path, probs.shape[1], probs.shape[0], format_str) as w:
+        w.write_rows(probs)
+    move_into_place(temp_path, out_path)
+
+
+def threshold_prob_map(path, threshold=0.5):
+    """
+    Segmentation from a saved probability map, read a band at a time.
+    This is the same as segmenting with {threshold}, apart from pixels
+    with a probability so close to the threshold that rounding when the
+    map was stored moved them across it. That is within 1/510 of the
+    threshold for uint8 maps and about 1/4000 of it for float16 maps.
+    """
+    with ProbMapReader(path) as reader:
+        seg = np.zeros((reader.height, reader.width), dtype=bool)
+        for top, probs in reader.bands():
+            seg[top : top + len(probs)] = probs > threshold
+    return seg
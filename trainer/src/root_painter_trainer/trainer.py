@@ -19,37 +19,44 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 # pylint: disable=W0511, E1136, C0111, R0902, R0914, W0703, R0913, R0915
 # W0511 is TODO
 import os
+import math
 import time
 import warnings
 from pathlib import Path
 import json
 from datetime import datetime
 from functools import partial
-import copy
+import contextlib
 import traceback
 import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from torch.nn.functional import softmax
 from torch.utils.data import DataLoader
+from root_painter_trainer.multi_epoch.multi_epoch_loader import MultiEpochsDataLoader
 from root_painter_trainer.loss import combined_loss as criterion
 
-from root_painter_trainer.datasets import TrainDataset
+from root_painter_trainer.datasets import TrainDataset, seed_worker
 from root_painter_trainer.metrics import (
-    get_metrics,
+    MetricAccumulator,
     get_metrics_str,
     get_metric_csv_row,
 )
-from root_painter_trainer.model_utils import ensemble_segment
 from root_painter_trainer.model_utils import create_first_model_with_random_weights
 from root_painter_trainer import model_utils
 from root_painter_trainer.model_utils import save_if_better
 
 from root_painter_trainer.im_utils import is_photo, load_image, save_then_move
-from root_painter_trainer.file_utils import ls
+from root_painter_trainer import im_utils
+from root_painter_trainer import elastic
+from root_painter_trainer.file_utils import ls, annot_fingerprint, prefetch_map
 from root_painter_trainer.startup import startup_setup, ensure_required_folders_exist
 from root_painter_trainer.unet import get_valid_patch_sizes
+from root_painter_trainer.watcher import create_watcher
+from root_painter_trainer.prob_map import prob_formats, save_prob_map, ProbMapWriter
 
 
 class Trainer:
@@ -58,6 +65,14 @@ class Trainer:
         sync_dir=None,
         patch_size=572,
         max_workers=12,
+        device=None,
+        watcher="auto",
+        precision="fp32",
+        batch_elastic=False,
+        prefetch_factor=2,
+        persistent_workers=True,
+        batch_size=None,
+        effective_batch_size=None,
         instruction_deleted_hook=None,
         segmentation_created_hook=None,
         model_saved_hook=None,
@@ -81,34 +96,64 @@ class Trainer:
 
         ensure_required_folders_exist(self.sync_dir)
         self.instruction_dir = os.path.join(self.sync_dir, "instructions")
+        self.watcher = create_watcher(self.instruction_dir, watcher)
+        print("Watching for instructions with", type(self.watcher).__name__)
         self.training = False
         self.train_set = None
+        # The data loader (and its worker processes) is kept between epochs
+        # when persistent_workers is True. prefetch_factor is the number of
+        # batches loaded in advance by each worker.
+        self.train_loader = None
+        self.train_loader_len = None
+        self.persistent_workers = persistent_workers
+        # do the elastic deformation on the device for the whole batch
+        # instead of in the data loader workers.
+        self.batch_elastic = batch_elastic
+        self.prefetch_factor = prefetch_factor
         # Can be set by instructions.
         self.train_config = None
         self.model = None
         self.first_loop = True
         self.in_w = patch_size
         self.out_w = self.in_w - 72
-        mem_per_item = 3800000000
-        total_mem = 0
         self.num_workers = min(multiprocessing.cpu_count(), max_workers)
         print(self.num_workers, "workers assigned for data loader")
         print("GPU Available", torch.cuda.is_available())
-        if torch.cuda.is_available():
-            for i in range(torch.cuda.device_count()):
-                total_mem += torch.cuda.get_device_properties(i).total_memory
-            self.bs = total_mem // mem_per_item
-            self.bs = min(12, self.bs)
-        else:
-            self.bs = 1  # cpu is batch size of 1
-        print("Batch size", self.bs)
+        self.device = model_utils.set_device(device)
+        print("Device", self.device)
+        print("Precision", model_utils.set_precision(precision))
+        self.set_batch_size(batch_size, effective_batch_size)
         self.optimizer = None
+        self.scaler = None
         # used to check for updates
         self.annot_mtimes = []
+        # validation metrics of saved models, keyed by model file name and
+        # the validation annotations they were computed on. Saves computing
+        # the previous model metrics again when nothing has changed.
+        self.val_metrics_store = {}
         self.msg_dir = None
         self.epochs_without_progress = 0
         # approx 30 minutes
         self.max_epochs_without_progress = 60
+        # Validation runs on this thread whilst the next epoch trains.
+        # val_future is the validation running (or done but not yet
+        # applied) and val_model the model it validates.
+        self.val_executor = ThreadPoolExecutor(max_workers=1)
+        self.val_future = None
+        self.val_model = None
+        self.val_stream = None
+        # training progress is printed every print_interval steps
+        self.print_interval = 20
+        # Images are read and segmentations written by these threads whilst
+        # the network segments. At most segment_queue_depth images are
+        # waiting at each end.
+        self.segment_io_workers = 4
+        self.segment_queue_depth = 8
+        # Images larger than this are segmented in bands of rows, each band
+        # roughly streaming_band_pixels in size, so they never need to be
+        # held in memory as a whole.
+        self.streaming_min_pixels = 10000 * 10000
+        self.streaming_band_pixels = 50000000
         # These can be triggered by data sent from client
         self.valid_instructions = [
             self.start_training,
@@ -120,7 +165,7 @@ class Trainer:
         print("Started main loop. Checking for instructions in", self.instruction_dir)
         while True:
             try:
-                self.check_for_instructions()
+                self.check_for_new_instructions()
             except Exception as e:
                 print("Exception check_for_instructions", e, traceback.format_exc())
                 self.log(
@@ -133,14 +178,20 @@ class Trainer:
                 self.train_one_epoch()
             else:
                 self.first_loop = True
-                time.sleep(1.0)
+                self.watcher.wait(1.0)
+
+    def check_for_new_instructions(self):
+        """check for instructions, but only if the
+        watcher says the instructions folder has changed"""
+        if self.watcher.changed():
+            self.check_for_instructions()
 
     def fix_config_paths(self, old_config):
         """get paths relative to local machine"""
         new_config = {}
         for k, v in old_config.items():
-            if k == "file_names" or k == "format":
-                # names and format specified dont need a path appending
+            if k in ["file_names", "format", "backend"]:
+                # names, format and backend specified dont need a path appending
                 new_config[k] = v
             elif isinstance(v, list):
                 # if its a list fix each string in the list.
@@ -237,23 +288,72 @@ class Trainer:
 
     def stop_training(self, _):
         if self.training:
+            # the last epoch is still validated (and saved if better),
+            # as it would have been if validation wasn't in the background.
+            self.apply_validation_result()
             self.training = False
             self.epochs_without_progress = 0
+            # shut down the data loader workers.
+            self.train_loader = None
             message = "Training stopped"
             self.write_message(message)
             self.log(message)
 
+    def set_batch_size(self, batch_size=None, effective_batch_size=None):
+        """
+        Use batch_size if given. Otherwise on GPU the largest batch (up to
+        effective_batch_size or 12) that fits in memory is found by trying
+        training steps, and on CPU the batch size is 1.
+
+        If effective_batch_size is given then gradients are accumulated
+        over enough batches to make up effective_batch_size tiles, so
+        training behaves the same on machines with different memory.
+        """
+        max_bs = effective_batch_size or 12
+        if batch_size:
+            self.bs = batch_size
+            source = "given"
+        elif self.device.type == "cuda":
+            # validation runs in the background whilst training so
+            # room is left for it.
+            self.bs = model_utils.find_batch_size(
+                self.in_w, self.out_w, max_bs, with_validation=True
+            )
+            source = "largest that fits in GPU memory with validation"
+        else:
+            self.bs = 1  # cpu is batch size of 1
+            source = "default for " + self.device.type
+        # number of batches the gradient is summed over for each step.
+        self.accumulation_steps = 1
+        if effective_batch_size:
+            self.accumulation_steps = math.ceil(effective_batch_size / self.bs)
+            self.bs = math.ceil(effective_batch_size / self.accumulation_steps)
+        message = (
+            f"Batch size {self.bs} ({source}) with {self.accumulation_steps}"
+            " gradient accumulation steps, effective batch size"
+            f" {self.bs * self.accumulation_steps}"
+        )
+        print(message)
+        self.log(message)
+
     def start_training(self, config):
         if not self.training:
             self.train_config = config
             self.epochs_without_progress = 0
+            self.val_metrics_store = {}
             self.msg_dir = self.train_config["message_dir"]
             model_dir = self.train_config["model_dir"]
+            self.train_loader = None
             self.train_set = TrainDataset(
                 self.train_config["train_annot_dir"],
                 self.train_config["dataset_dir"],
                 self.in_w,
                 self.out_w,
+                # sample images with more annotation more often.
+                weighted=self.train_config.get("weighted_sampling", False),
+                batch_elastic=self.batch_elastic,
+                # reuse elastic maps from a pool refreshed in the background.
+                elastic_pool_size=self.train_config.get("elastic_pool_size", 0),
             )
             model_paths = model_utils.get_latest_model_paths(model_dir, 1)
             if model_paths:
@@ -263,6 +363,7 @@ class Trainer:
             self.optimizer = torch.optim.SGD(
                 self.model.parameters(), lr=0.01, momentum=0.99, nesterov=True
             )
+            self.scaler = model_utils.get_grad_scaler()
             self.model.train()
             self.training = True
 
@@ -297,36 +398,27 @@ class Trainer:
             self.write_message("Training started")
             self.log("Starting Training")
 
-        train_loader = DataLoader(
-            self.train_set,
-            self.bs,
-            shuffle=True,
-            # 12 workers is good for performance
-            # on 2 RTX2080 Tis (but depends on CPU also)
-            # 0 workers is good for debugging
-            # don't go above max_workers (user specified but default 12)
-            # and don't go above the number of cpus, provided by cpu_count.
-            num_workers=self.num_workers,
-            drop_last=False,
-            pin_memory=True,
-        )
+        train_loader = self.get_train_loader()
         epoch_start = time.time()
         self.model.train()
-        tps = 0
-        fps = 0
-        tns = 0
-        fns = 0
-        defined_total = 0
-        loss_sum = 0
+        metrics = MetricAccumulator()
+        self.optimizer.zero_grad()
         for step, (photo_tiles, foreground_tiles, defined_tiles) in enumerate(
             train_loader
         ):
-            self.check_for_instructions()
-            photo_tiles = photo_tiles.cuda()
-            foreground_tiles = foreground_tiles.cuda()
-            defined_tiles = defined_tiles.cuda()
-            self.optimizer.zero_grad()
-            outputs = self.model(photo_tiles)
+            self.check_for_new_instructions()
+            # non_blocking copies from pinned memory overlap with compute.
+            photo_tiles = model_utils.to_device(photo_tiles, non_blocking=True)
+            foreground_tiles = foreground_tiles.to(self.device, non_blocking=True)
+            defined_tiles = defined_tiles.to(self.device, non_blocking=True)
+            if self.batch_elastic:
+                photo_tiles, foreground_tiles, defined_tiles = self.elastic_batch(
+                    photo_tiles, foreground_tiles, defined_tiles
+                )
+            with model_utils.autocast():
+                outputs = self.model(photo_tiles)
+            # the loss sums over many pixels so is computed in float32.
+            outputs = outputs.float()
             softmaxed = softmax(outputs, 1)
             # just the foreground probability.
             foreground_probs = softmaxed[:, 1, :]
@@ -336,49 +428,90 @@ class Trainer:
             outputs[:, 0] *= defined_tiles
             outputs[:, 1] *= defined_tiles
             loss = criterion(outputs, foreground_tiles)
-            loss.backward()
-            self.optimizer.step()
-            foreground_probs *= defined_tiles
-            predicted = foreground_probs > 0.5
+            # the gradient of the mean loss over the accumulated batches.
+            self.scaler.scale(loss / self.accumulation_steps).backward()
+            last_step = step + 1 == len(train_loader)
+            if (step + 1) % self.accumulation_steps == 0 or last_step:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad()
+            predicted = foreground_probs.detach() > 0.5
 
             # we only want to calculate metrics on the
-            # part of the predictions for which annotations are defined
-            # so remove all predictions and foreground labels where
-            # we didn't have any annotation.
-
-            defined_list = defined_tiles.view(-1)
-            preds_list = predicted.view(-1)[defined_list > 0]
-            foregrounds_list = foreground_tiles.view(-1)[defined_list > 0]
-
-            # # calculate all the false positives, false negatives etc
-            tps += torch.sum((foregrounds_list == 1) * (preds_list == 1)).cpu().numpy()
-            tns += torch.sum((foregrounds_list == 0) * (preds_list == 0)).cpu().numpy()
-            fps += torch.sum((foregrounds_list == 0) * (preds_list == 1)).cpu().numpy()
-            fns += torch.sum((foregrounds_list == 1) * (preds_list == 0)).cpu().numpy()
-            defined_total += torch.sum(defined_list > 0).cpu().numpy()
-            loss_sum += loss.item()  # float
-
-            # https://github.com/googlecolab/colabtools/issues/166
-            print(
-                f"\rTraining: {(step + 1) * self.bs}/"
-                f"{len(train_loader.dataset)} "
-                f" loss={round(loss.item(), 3)}",
-                end="",
-                flush=True,
-            )
+            # part of the predictions for which annotations are defined.
+            # The sums stay on the device until the end of the epoch.
+            metrics.add(predicted, foreground_tiles, defined_tiles, loss)
+
+            if step % self.print_interval == 0:
+                # reading the loss waits for the device, so not every step.
+                # https://github.com/googlecolab/colabtools/issues/166
+                print(
+                    f"\rTraining: {(step + 1) * self.bs}/"
+                    f"{len(train_loader.dataset)} "
+                    f" loss={round(loss.item(), 3)}",
+                    end="",
+                    flush=True,
+                )
 
-            self.check_for_instructions()  # could update training parameter
+            self.check_for_new_instructions()  # could update training parameter
             if not self.training:
                 return
 
         duration = round(time.time() - epoch_start, 3)
         print("epoch train duration", duration)
-        self.log_metrics(
-            "train", get_metrics(tps, fps, tns, fns, defined_total, duration)
-        )
-        before_val_time = time.time()
+        self.log_metrics("train", metrics.get_metrics(duration))
         self.validation()
-        print("epoch validation duration", time.time() - before_val_time)
+
+    def elastic_batch(self, photo_tiles, foreground_tiles, defined_tiles):
+        """
+        Elastic deformation of a batch of training tiles on the device.
+        The annotation is cropped to the output size afterwards so the
+        deformation doesn't remove the edges.
+        """
+        annots = torch.stack([foreground_tiles.float(), defined_tiles], dim=1)
+        photo_tiles, annots = elastic.transform_batch(photo_tiles, annots)
+        tile_pad = (self.in_w - self.out_w) // 2
+        annots = annots[:, :, tile_pad:-tile_pad, tile_pad:-tile_pad]
+        # back to channels last if using mixed precision.
+        photo_tiles = model_utils.to_device(photo_tiles)
+        return photo_tiles, annots[:, 0].long(), annots[:, 1].contiguous()
+
+    def get_train_loader(self):
+        """
+        Starting the data loader workers takes a while, so when
+        persistent_workers is True the loader is kept between epochs and
+        only created again when training starts or the dataset size changes.
+        """
+        dataset_len = len(self.train_set)
+        if self.train_loader is not None and self.train_loader_len == dataset_len:
+            return self.train_loader
+        # drop the old loader first so its workers are shut down.
+        self.train_loader = None
+        kwargs = {}
+        if self.num_workers > 0:
+            kwargs["prefetch_factor"] = self.prefetch_factor
+        loader_class = DataLoader
+        if self.persistent_workers:
+            loader_class = MultiEpochsDataLoader
+        train_loader = loader_class(
+            self.train_set,
+            self.bs,
+            shuffle=True,
+            # 12 workers is good for performance
+            # on 2 RTX2080 Tis (but depends on CPU also)
+            # 0 workers is good for debugging
+            # don't go above max_workers (user specified but default 12)
+            # and don't go above the number of cpus, provided by cpu_count.
+            num_workers=self.num_workers,
+            drop_last=False,
+            pin_memory=self.device.type == "cuda",
+            worker_init_fn=seed_worker,
+            **kwargs,
+        )
+        if self.persistent_workers:
+            self.train_loader = train_loader
+            self.train_loader_len = dataset_len
+        return train_loader
 
     def log_metrics(self, name, metrics):
         fname = datetime.today().strftime("%Y-%m-%d")
@@ -396,35 +529,105 @@ class Trainer:
             log_file.flush()
 
     def validation(self):
-        """Get validation set metrics for current model and previous model.
-        log those metrics and update the model if the
-        current model is better than the previous model.
-        Also stop training if the current model hasn't
-        beat the previous model for {max_epochs}
         """
-        model_dir = self.train_config["model_dir"]
-        # TODO consider implementing checkpointer class to maintain
-        # this state.
+        Validate the current model in the background (see validate_snapshot)
+        so the next epoch can train meanwhile. The result of the previous
+        validation is applied first, waiting for it if it hasn't finished,
+        so each epoch is validated whilst the next one trains.
+        """
+        self.apply_validation_result()
+        if not self.training:
+            return
+        snapshot = model_utils.get_state_dict_snapshot(self.model)
+        snapshot_ready = None
+        if self.device.type == "cuda":
+            # the validation stream waits for the snapshot to be copied.
+            snapshot_ready = torch.cuda.Event()
+            snapshot_ready.record()
+        self.val_future = self.val_executor.submit(
+            self.validate_snapshot, snapshot, snapshot_ready, self.train_config
+        )
+
+    def validate_snapshot(self, snapshot, snapshot_ready, train_config):
+        """Get validation set metrics for the snapshot and previous model.
+        Runs on the validation thread, using its own CUDA stream."""
         get_val_metrics = partial(
             model_utils.get_val_metrics,
-            val_annot_dir=self.train_config["val_annot_dir"],
-            dataset_dir=self.train_config["dataset_dir"],
+            val_annot_dir=train_config["val_annot_dir"],
+            dataset_dir=train_config["dataset_dir"],
             in_w=self.in_w,
             out_w=self.out_w,
             bs=self.bs,
         )
-        prev_model, prev_path = model_utils.get_prev_model(model_dir)
-        cur_metrics = get_val_metrics(copy.deepcopy(self.model))
-        prev_metrics = get_val_metrics(prev_model)
+        stream_context = contextlib.nullcontext()
+        if snapshot_ready is not None:
+            if self.val_stream is None:
+                self.val_stream = torch.cuda.Stream()
+            self.val_stream.wait_event(snapshot_ready)
+            stream_context = torch.cuda.stream(self.val_stream)
+        val_fingerprint = annot_fingerprint(train_config["val_annot_dir"])
+        prev_path = model_utils.get_latest_model_paths(train_config["model_dir"], 1)[0]
+        prev_key = (os.path.basename(prev_path), val_fingerprint)
+        with stream_context:
+            # the same model is reused for each snapshot.
+            self.val_model = model_utils.model_from_state_dict(snapshot, self.val_model)
+            self.val_model.eval()
+            cur_metrics = get_val_metrics(self.val_model)
+            prev_metrics = self.val_metrics_store.get(prev_key)
+            if prev_metrics is None:
+                prev_metrics = get_val_metrics(prev_path)
+        if self.val_stream is not None:
+            self.val_stream.synchronize()
+        if annot_fingerprint(train_config["val_annot_dir"]) != val_fingerprint:
+            # an annotation was saved whilst validating, so the metrics may
+            # be from a mix of the old and new annotations.
+            val_fingerprint = None
+        return prev_path, prev_key, val_fingerprint, cur_metrics, prev_metrics
+
+    def apply_validation_result(self):
+        """
+        Log the metrics from the last validation. Save the validated model
+        if it's better than the previous model, and stop training if no
+        model has beaten the previous model for {max_epochs}.
+        """
+        if self.val_future is None:
+            return
+        val_future = self.val_future
+        # cleared first so a failed validation isn't waited on again.
+        self.val_future = None
+        before_wait = time.time()
+        try:
+            result = val_future.result()
+        except Exception as e:
+            print("Exception in validation", e)
+            self.log(f"Exception in validation,{e},{traceback.format_exc()}")
+            return
+        print("waited for validation", round(time.time() - before_wait, 3))
+        prev_path, prev_key, val_fingerprint, cur_metrics, prev_metrics = result
+        model_dir = self.train_config["model_dir"]
+        # TODO consider implementing checkpointer class to maintain
+        # this state.
+        if val_fingerprint is None:
+            # the metrics are not stored (see validate_snapshot).
+            self.val_metrics_store = {}
+        elif prev_key not in self.val_metrics_store:
+            self.val_metrics_store = {prev_key: prev_metrics}
         self.log_metrics("cur_val", cur_metrics)
         self.log_metrics("prev_val", prev_metrics)
+        # self.val_model has the validated weights, which the training
+        # model has moved on from.
         was_saved = save_if_better(
-            model_dir, self.model, prev_path, cur_metrics["f1"], prev_metrics["f1"]
+            model_dir, self.val_model, prev_path, cur_metrics["f1"], prev_metrics["f1"]
         )
         if was_saved:
             self.epochs_without_progress = 0
+            latest_model_path = model_utils.get_latest_model_paths(model_dir, 1)[0]
+            # The saved model is the one just validated so
+            # its metrics are already known.
+            if val_fingerprint is not None:
+                latest_key = (os.path.basename(latest_model_path), val_fingerprint)
+                self.val_metrics_store = {latest_key: cur_metrics}
             if self.model_saved_hook:
-                latest_model_path = model_utils.get_latest_model_paths(model_dir, 1)[0]
                 self.model_saved_hook(latest_model_path)
 
         else:
@@ -482,6 +685,8 @@ class Trainer:
         format_str = "RootPainter Default (.png)"
         if "format" in segment_config:
             format_str = segment_config["format"]
+        # how the network is run, see model_utils.inference_backends
+        backend = segment_config.get("backend")
 
         if "file_names" in segment_config:
             fnames = segment_config["file_names"]
@@ -500,15 +705,63 @@ class Trainer:
             if not model_paths:
                 create_first_model_with_random_weights(model_dir)
                 model_paths = model_utils.get_latest_model_paths(model_dir, 1)
+        if backend == "int8":
+            # quantized models are calibrated on the dataset being segmented.
+            for model_path in model_paths:
+                model_utils.ensure_quantized(model_path, in_dir, self.in_w)
         start = time.time()
-        for fname in fnames:
-            self.segment_file(in_dir, seg_dir, fname, model_paths, format_str)
+        self.segment_files(in_dir, seg_dir, fnames, model_paths, format_str, backend)
         duration = time.time() - start
         print(f"Seconds to segment {len(fnames)} images: ", round(duration, 3))
 
-    def segment_file(self, in_dir, seg_dir, fname, model_paths, format_str):
-        fpath = os.path.join(in_dir, fname)
+    def segment_file(
+        self, in_dir, seg_dir, fname, model_paths, format_str, backend=None
+    ):
+        self.segment_files(in_dir, seg_dir, [fname], model_paths, format_str, backend)
+
+    def segment_files(
+        self, in_dir, seg_dir, fnames, model_paths, format_str, backend=None
+    ):
+        """Segment {fnames} from {in_dir} and save to {seg_dir}.
+
+        Runs as a pipeline: images are loaded ahead of time by a pool of
+        reader threads, tiles from consecutive images are segmented in the
+        same batch and the segmentations are saved by a pool of writer
+        threads, so the network isn't waiting on image decode or encode.
+        """
+        self.write_not_training_message(seg_dir)
+        images = self.load_images_to_segment(
+            in_dir, seg_dir, fnames, model_paths, format_str, backend
+        )
+        # probability formats are saved without thresholding.
+        threshold = None if format_str in prob_formats else 0.5
+        seg_start = time.time()
+        with ThreadPoolExecutor(self.segment_io_workers) as writers:
+            pending_writes = deque()
+            for (fname, out_path), seg_out in model_utils.ensemble_segment_images(
+                model_paths,
+                images,
+                self.bs,
+                self.in_w,
+                self.out_w,
+                threshold=threshold,
+                backend=backend,
+            ):
+                print(
+                    f"ensemble segment {fname}, dur", round(time.time() - seg_start, 2)
+                )
+                pending_writes.append(
+                    writers.submit(
+                        self.save_segmentation, out_path, seg_out, format_str
+                    )
+                )
+                if len(pending_writes) >= self.segment_queue_depth:
+                    pending_writes.popleft().result()
+                seg_start = time.time()
+            while pending_writes:
+                pending_writes.popleft().result()
 
+    def write_not_training_message(self, seg_dir):
         # When the client navigates through images, there is a risk that
         # they may not realise that training has not been started.
         # These segmentation instructions keep getting processed so
@@ -535,50 +788,163 @@ class Trainer:
             stack = traceback.format_exc()
             print("exception writing message", e, stack)
 
-        npy = False
+    def get_seg_out_path(self, seg_dir, fname, format_str):
         if format_str == "Numpy Compressed (.npz)":
-            # segmentation output is a binary map.
-            npy = True
-            out_path = os.path.join(seg_dir, os.path.splitext(fname)[0] + ".npz")
-        else:
-            out_path = os.path.join(seg_dir, os.path.splitext(fname)[0] + ".png")
+            return os.path.join(seg_dir, os.path.splitext(fname)[0] + ".npz")
+        if format_str in prob_formats:
+            ext, _ = prob_formats[format_str]
+            return os.path.join(seg_dir, os.path.splitext(fname)[0] + ext)
+        return os.path.join(seg_dir, os.path.splitext(fname)[0] + ".png")
+
+    def load_images_to_segment(
+        self, in_dir, seg_dir, fnames, model_paths, format_str, backend=None
+    ):
+        """yield ((fname, out_path), photo) for each image
+        that has not already been segmented.
+        Images are loaded ahead of time by a pool of threads.
+
+        Images too large to load are segmented in bands
+        as they are reached instead of being yielded."""
+        read = partial(
+            self.load_image_to_segment,
+            in_dir=in_dir,
+            seg_dir=seg_dir,
+            format_str=format_str,
+        )
+        loaded = prefetch_map(
+            read, fnames, self.segment_io_workers, self.segment_queue_depth
+        )
+        for image in loaded:
+            if image is None:
+                continue
+            (fname, out_path), photo = image
+            if photo is None:
+                fpath = os.path.join(in_dir, fname)
+                self.segment_file_streaming(
+                    fpath, out_path, model_paths, format_str, backend
+                )
+            else:
+                yield image
 
+    def load_image_to_segment(self, fname, in_dir, seg_dir, format_str):
+        """return ((fname, out_path), photo) or None if
+        the image should not be segmented"""
+        fpath = os.path.join(in_dir, fname)
+        out_path = self.get_seg_out_path(seg_dir, fname, format_str)
         if os.path.isfile(out_path):
             print("Skip because found existing segmentation file")
-            return
+            return None
         if not os.path.isfile(fpath):
             print("Cannot segment as missing file", fpath)
-        else:
-            try:
-                photo = load_image(fpath)
-            except Exception as e:
-                # Could be temporary issues reading the image.
-                # its ok just skip it.
-                print("Exception loading", fpath, e)
-                return
-            seg_start = time.time()
-            seg_out = ensemble_segment(
-                model_paths, photo, self.bs, self.in_w, self.out_w
-            )
-            print(f"ensemble segment {fname}, dur", round(time.time() - seg_start, 2))
-            # catch warnings as low contrast is ok here.
-            with warnings.catch_warnings():
-                # create a version with alpha channel
-                warnings.simplefilter("ignore")
-
-                if format_str == "RhizoVision Explorer (.png)":
-                    # RVE needs segmentation in black and white
-                    # Load RootPainter blue channel and invert.
-                    seg_out = seg_out == 0
-                elif npy:
-                    seg_out = seg_out.astype(bool)
-                else:
-                    # default output is PNG with alpha channel
-                    seg_alpha = np.zeros((seg_out.shape[0], seg_out.shape[1], 4))
-                    seg_alpha[seg_out > 0] = [0, 1.0, 1.0, 0.7]
-                    # Convert to uint8 to save as png without warning
-                    seg_out = (seg_alpha * 255).astype(np.uint8)
-
-                save_then_move(out_path, seg_out, npy)
-                if self.segmentation_created_hook:
-                    self.segmentation_created_hook(out_path)
+            return None
+        try:
+            width, height = im_utils.get_image_size(fpath)
+            if width * height > self.streaming_min_pixels:
+                # too large to load, will be segmented in bands.
+                return (fname, out_path), None
+            photo = load_image(fpath)
+        except Exception as e:
+            # Could be temporary issues reading the image.
+            # its ok just skip it.
+            print("Exception loading", fpath, e)
+            return None
+        return (fname, out_path), photo
+
+    def save_segmentation(self, out_path, seg_out, format_str):
+        """Save seg_out in the specified format.
+        Called from the writer threads when segmenting"""
+        if format_str in prob_formats:
+            # seg_out is the foreground probability
+            save_prob_map(out_path, seg_out, format_str)
+            if self.segmentation_created_hook:
+                self.segmentation_created_hook(out_path)
+            return
+        # segmentation output is a binary map.
+        npy = format_str == "Numpy Compressed (.npz)"
+        # catch warnings as low contrast is ok here.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            seg_out = self.format_segmentation(seg_out, format_str)
+            save_then_move(out_path, seg_out, npy)
+            if self.segmentation_created_hook:
+                self.segmentation_created_hook(out_path)
+
+    def format_segmentation(self, seg_out, format_str):
+        """convert the predicted segmentation to the array that is saved"""
+        if format_str == "RhizoVision Explorer (.png)":
+            # RVE needs segmentation in black and white
+            # Load RootPainter blue channel and invert.
+            return seg_out == 0
+        if format_str == "Numpy Compressed (.npz)":
+            return seg_out.astype(bool)
+        # default output is PNG with alpha channel
+        seg_alpha = np.zeros((seg_out.shape[0], seg_out.shape[1], 4), dtype=np.uint8)
+        # [0, 1.0, 1.0, 0.7] as uint8 to save as png without warning
+        seg_alpha[seg_out > 0] = [0, 255, 255, 178]
+        return seg_alpha
+
+    def segment_file_streaming(
+        self, fpath, out_path, model_paths, format_str, backend=None
+    ):
+        """Segment an image too large to hold in memory, a band of
+        rows at a time, writing the output as each band is segmented."""
+        seg_start = time.time()
+        reader = im_utils.ImageBandReader(fpath)
+        band_h = self.streaming_band_pixels // reader.width
+        band_h = max(1, band_h // self.out_w) * self.out_w
+        bands = model_utils.ensemble_segment_bands(
+            model_paths,
+            reader.read,
+            reader.height,
+            self.bs,
+            self.in_w,
+            self.out_w,
+            band_h,
+            threshold=None if format_str in prob_formats else 0.5,
+            backend=backend,
+        )
+        fname = os.path.basename(out_path)
+        temp_path = os.path.join(os.path.dirname(out_path), ".tmp." + fname)
+        try:
+            if format_str in prob_formats:
+                with ProbMapWriter(
+                    temp_path, reader.width, reader.height, format_str
+                ) as writer:
+                    for band in bands:
+                        writer.write_rows(band)
+                im_utils.move_into_place(temp_path, out_path)
+            elif format_str == "Numpy Compressed (.npz)":
+                # npz can't be written in parts so collect the
+                # segmentation in a memory-mapped file first.
+                seg_out = np.lib.format.open_memmap(
+                    temp_path + ".npy",
+                    mode="w+",
+                    dtype=bool,
+                    shape=(reader.height, reader.width),
+                )
+                top = 0
+                for band in bands:
+                    seg_out[top : top + band.shape[0]] = band
+                    top += band.shape[0]
+                save_then_move(out_path, seg_out, npy=True)
+                del seg_out
+            else:
+                channels = 1 if format_str == "RhizoVision Explorer (.png)" else 4
+                with im_utils.PNGRowWriter(
+                    temp_path, reader.width, reader.height, channels
+                ) as writer:
+                    for band in bands:
+                        band = self.format_segmentation(band, format_str)
+                        if channels == 1:
+                            band = band.astype(np.uint8) * 255
+                        writer.write_rows(band)
+                im_utils.move_into_place(temp_path, out_path)
+        finally:
+            reader.close()
+            # remove temporary files left by a failed segmentation.
+            for path in [temp_path, temp_path + ".npy"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        print(f"streaming segment {fname}, dur", round(time.time() - seg_start, 2))
+        if self.segmentation_created_hook:
+            self.segmentation_created_hook(out_path)
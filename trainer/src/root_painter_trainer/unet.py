@@ -23,6 +23,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import torch.fx
 import torch.nn as nn
 
 
@@ -69,6 +70,11 @@ def crop_tensor(tensor, target):
     return cropped_tensor
 
 
+# crop_tensor uses the size of its inputs, which torch.fx can't trace,
+# so it is kept as a single call in traced graphs (used for quantization).
+torch.fx.wrap("crop_tensor")
+
+
 class UpBlock(nn.Module):
     def __init__(self, in_channels):
         super().__init__()
@@ -0,0 +1,155 @@
+"""
+Watch the instructions folder so new instructions are seen without
+listing the folder over and over.
+
+Copyright (C) 2020 Abraham George Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# pylint: disable=C0111
+import os
+import sys
+import time
+import select
+import ctypes
+import ctypes.util
+
+# File systems where changes made on another machine are not reported
+# by inotify. The sync dir is often one of these (sshfs, Google Drive etc).
+network_fs_types = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph"}
+
+
+def create_watcher(dir_path, backend="auto", poll_interval=1.0):
+    """
+    Create a watcher for dir_path.
+    backend can be 'inotify', 'poll' or 'auto'. With 'auto', inotify is used
+    on Linux unless dir_path is on a network file system.
+    """
+    if backend == "auto":
+        backend = "poll"
+        if sys.platform.startswith("linux") and not is_network_fs(dir_path):
+            backend = "inotify"
+    if backend == "inotify":
+        try:
+            return InotifyWatcher(dir_path)
+        except OSError as e:
+            print("Could not watch", dir_path, "with inotify, will poll instead", e)
+    return PollingWatcher(dir_path, poll_interval)
+
+
+def get_fs_type(dir_path):
+    """file system type of the mount dir_path is on (Linux only)"""
+    dir_path = os.path.realpath(dir_path)
+    best_mount = ""
+    fs_type = None
+    with open("/proc/mounts", "r") as mounts:
+        for line in mounts:
+            parts = line.split()
+            mount_point, mount_type = parts[1], parts[2]
+            if os.path.commonpath([dir_path, mount_point]) == mount_point:
+                if len(mount_point) > len(best_mount):
+                    best_mount = mount_point
+                    fs_type = mount_type
+    return fs_type
+
+
+def is_network_fs(dir_path):
+    try:
+        fs_type = get_fs_type(dir_path)
+    except OSError:
+        return True  # can't tell, polling always works.
+    if fs_type is None:
+        return True
+    # fuse.sshfs, fuse.rclone etc. fuseblk is a local disk.
+    return fs_type in network_fs_types or fs_type.startswith("fuse.")
+
+
+class PollingWatcher:
+    """Report a change at most once every poll_interval seconds."""
+
+    def __init__(self, dir_path, poll_interval=1.0):
+        self.dir_path = dir_path
+        self.poll_interval = poll_interval
+        self.last_poll = None
+
+    def changed(self):
+        """True if the folder should be checked for new files"""
+        now = time.monotonic()
+        if self.last_poll is None or now - self.last_poll >= self.poll_interval:
+            self.last_poll = now
+            return True
+        return False
+
+    def wait(self, timeout):
+        """block for up to timeout seconds, until the folder may have changed"""
+        if self.last_poll is not None:
+            remaining = self.poll_interval - (time.monotonic() - self.last_poll)
+            time.sleep(max(0, min(timeout, remaining)))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Use Linux inotify to be told as soon as a file is written
+    to (or moved into) the folder.
+
+    The folder is also reported as changed every resync_interval
+    seconds, so instructions that could not be run the first time
+    are tried again.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, dir_path, resync_interval=10.0):
+        self.dir_path = dir_path
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        watch = libc.inotify_add_watch(
+            self.fd, os.fsencode(dir_path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        )
+        if watch < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno))
+        self.resync = PollingWatcher(dir_path, resync_interval)
+
+    def changed(self):
+        """True if the folder should be checked for new files"""
+        had_events = self.read_events()
+        return self.resync.changed() or had_events
+
+    def read_events(self):
+        """read all pending events, returning True if there were any"""
+        had_events = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return had_events
+            if not data:
+                return had_events
+            had_events = True
+
+    def wait(self, timeout):
+        """block for up to timeout seconds, until the folder may have changed"""
+        select.select([self.fd], [], [], timeout)
+
+    def close(self):
+        os.close(self.fd)
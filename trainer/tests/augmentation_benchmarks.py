@@ -0,0 +1,117 @@
+"""
+Time the data augmentation used for each training sample.
+This is a benchmark rather than a test, run with:
+
+    python -m tests.augmentation_benchmarks
+
+Copyright (C) 2023 Abraham George Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+
+import numpy as np
+from PIL import Image
+from skimage import img_as_float32
+from scipy.ndimage import gaussian_filter
+from skimage.exposure import rescale_intensity
+from skimage.transform import resize
+
+from root_painter_trainer import elastic
+from root_painter_trainer.datasets import UNetTransformer
+
+repeats = 200
+
+
+def get_tile(in_w=572):
+    tile = np.random.randint(0, 255, size=(in_w, in_w, 3), dtype=np.uint8)
+    return img_as_float32(tile)
+
+
+def time_fn(name, fn):
+    tile = get_tile()
+    annot = np.zeros((tile.shape[0], tile.shape[1], 2), dtype=bool)
+    start = time.time()
+    for _ in range(repeats):
+        fn(tile, annot)
+    duration = (time.time() - start) / repeats
+    print(f"{name}: {duration * 1000:.2f} ms per tile")
+    return duration
+
+
+def pil_color_jit_transform(photo, annot):
+    """ColorJitter as it was done before, using PIL and torchvision"""
+    from torchvision.transforms import ColorJitter
+
+    color_jit = ColorJitter(brightness=0.3, contrast=0.3, saturation=0.2, hue=0.001)
+    photo = rescale_intensity(photo, out_range=(0, 255))
+    photo = Image.fromarray((photo).astype(np.int8), mode="RGB")
+    photo = color_jit(photo)
+    photo = img_as_float32(np.array(photo))
+    return photo, annot
+
+
+def color_jitter_benchmark():
+    augmentor = UNetTransformer()
+    pil_duration = time_fn("color jitter (PIL, torchvision)", pil_color_jit_transform)
+    duration = time_fn("color jitter (numpy)", augmentor.color_jit_transform)
+    print(f"color jitter speedup {pil_duration / duration:.2f}x")
+
+
+def skimage_get_indices(im_shape, scale, sigma, padding=60):
+    """elastic.get_indices as it was done before, using skimage resize"""
+    im_shape = [im_shape[0] + (padding * 2), im_shape[1] + (padding * 2)]
+    resize_coef = 8
+    smaller = (im_shape[0] // resize_coef, im_shape[1] // resize_coef)
+    sigma /= resize_coef / 2
+    scale /= resize_coef / 2
+    randx = np.random.uniform(low=-1.0, high=1.0, size=smaller)
+    randy = np.random.uniform(low=-1.0, high=1.0, size=smaller)
+    x_filtered = gaussian_filter(randx, sigma, mode="reflect") * scale
+    y_filtered = gaussian_filter(randy, sigma, mode="reflect") * scale
+    x_filtered = resize(x_filtered, im_shape[:2])
+    y_filtered = resize(y_filtered, im_shape[:2])
+    x_coords, y_coords = np.mgrid[0 : im_shape[0], 0 : im_shape[1]]
+    return x_coords + x_filtered, y_coords + y_filtered
+
+
+def elastic_map_benchmark():
+    alpha, sigma = elastic.get_elastic_params(scale=0.5, intensity=0.7)
+
+    def skimage_map(photo, _):
+        skimage_get_indices(photo.shape, alpha, sigma)
+
+    def zoom_map(photo, _):
+        elastic.get_indices(photo.shape, alpha, sigma)
+
+    pool = elastic.ElasticMapPool(get_tile().shape, size=8)
+
+    def pool_map(*_):
+        pool.get()
+
+    skimage_duration = time_fn("elastic map (skimage resize)", skimage_map)
+    duration = time_fn("elastic map (separable zoom)", zoom_map)
+    print(f"elastic map speedup {skimage_duration / duration:.2f}x")
+    time_fn("elastic map (pool of 8)", pool_map)
+
+
+def transform_benchmark():
+    augmentor = UNetTransformer()
+    time_fn("all augmentation", augmentor.transform)
+
+
+if __name__ == "__main__":
+    color_jitter_benchmark()
+    elastic_map_benchmark()
+    transform_benchmark()
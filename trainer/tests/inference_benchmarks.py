@@ -0,0 +1,64 @@
+"""
+Time segmentation with each of the inference backends.
+This is a benchmark rather than a test, run with:
+
+    python -m tests.inference_benchmarks
+
+Copyright (C) 2023 Abraham George Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import tempfile
+
+import numpy as np
+import torch
+
+from root_painter_trainer import model_utils
+
+repeats = 3
+
+
+def backend_benchmark(backends, bs, image_shape=(1500, 2000, 3)):
+    image = np.random.randint(0, 255, size=image_shape, dtype=np.uint8)
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_utils.create_first_model_with_random_weights(model_dir)
+        model_paths = model_utils.get_latest_model_paths(model_dir, 1)
+        durations = {}
+        for backend in backends:
+            start = time.time()
+            model_utils.get_inference_engine(model_paths[0], 572, bs, backend)
+            build_duration = time.time() - start
+            start = time.time()
+            for _ in range(repeats):
+                model_utils.ensemble_segment(
+                    model_paths, image, bs, 572, 500, backend=backend
+                )
+            durations[backend] = (time.time() - start) / repeats
+            print(
+                f"{backend}: build {build_duration:.2f} s, "
+                f"segment {durations[backend]:.2f} s per image"
+            )
+        for backend in backends[1:]:
+            speedup = durations[backends[0]] / durations[backend]
+            print(f"{backend} speedup over {backends[0]} {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    # backends can be given on the command line, the first is the baseline.
+    backends = sys.argv[1:] or ["eager", "torchscript", "compile"]
+    bs = 1 if model_utils.device.type == "cpu" else 4
+    print("device", model_utils.device, "batch size", bs, "torch", torch.__version__)
+    backend_benchmark(backends, bs)
@@ -0,0 +1,44 @@
+"""
+Compare the int8 quantized model with the float32 model on a project's
+validation annotations. This is a report rather than a test, run with:
+
+    python -m tests.quantization_report model.pkl val_annot_dir dataset_dir
+
+Copyright (C) 2023 Abraham George Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+
+from root_painter_trainer import model_utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("model_path", help="checkpoint (.pkl) to quantize")
+parser.add_argument("val_annot_dir", help="validation annotations of the project")
+parser.add_argument("dataset_dir", help="images of the project")
+parser.add_argument("--bs", type=int, default=4, help="batch size")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    model_utils.set_device("cpu")
+    report = model_utils.quantization_report(
+        args.model_path, args.val_annot_dir, args.dataset_dir, 572, 500, args.bs
+    )
+    print(f"fp32 f1 {report['fp32_f1']:.4f}, int8 f1 {report['int8_f1']:.4f}")
+    print(f"f1 drift {report['f1_drift']:+.4f}")
+    print(
+        f"fp32 {report['fp32_duration']:.2f} s, int8 {report['int8_duration']:.2f} s"
+        f", speedup {report['speedup']:.2f}x"
+    )
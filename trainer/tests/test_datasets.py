@@ -0,0 +1,76 @@
+"""
+Tests for the training data augmentation.
+"""
+
+import random
+
+import numpy as np
+import pytest
+import torch
+from augmentation_benchmarks import pil_color_jit_transform
+
+from root_painter_trainer.datasets import UNetTransformer, normalize_in_place
+
+
+def get_tile_and_annot(in_w=100):
+    tile = np.random.randint(0, 255, size=(in_w, in_w, 3), dtype=np.uint8)
+    annot = np.zeros((in_w, in_w, 2), dtype=bool)
+    annot[10:20, 10:30, 0] = True
+    return tile, annot
+
+
+def test_transform_returns_normalized_channels_first():
+    tile, annot = get_tile_and_annot()
+    original = tile.copy()
+    augmentor = UNetTransformer()
+    for _ in range(10):
+        photo, annot_out = augmentor.transform(tile, annot)
+        assert photo.shape == (3, 100, 100)
+        assert photo.dtype == np.float32
+        assert photo.min() == 0 and photo.max() == 1
+        assert annot_out.shape == annot.shape
+    # the tile is not changed, as it may be from the image cache.
+    assert np.array_equal(tile, original)
+
+
+def test_transform_is_repeatable_when_seeded():
+    tile, annot = get_tile_and_annot()
+    augmentor = UNetTransformer(elastic=False)
+    photos = []
+    for _ in range(2):
+        random.seed(1)
+        augmentor.seed(2)
+        photos.append(augmentor.transform(tile, annot)[0])
+    assert np.array_equal(photos[0], photos[1])
+
+
+def get_jitter_stats(photos):
+    """per channel mean and std and the fraction of saturated pixels"""
+    photos = np.array(photos)
+    means = photos.mean(axis=(0, 1, 2))
+    stds = photos.std(axis=(1, 2)).mean(axis=0)
+    saturated = np.mean((photos <= 0) | (photos >= 1))
+    return means, stds, saturated
+
+
+# the PIL jitter is done as it was before, with the deprecated Image mode.
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_color_jitter_matches_torchvision():
+    random.seed(0)
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    augmentor = UNetTransformer()
+    y, x = np.mgrid[0:64, 0:64] / 64
+    base = np.stack([0.2 + 0.5 * y, 0.3 + 0.3 * x, 0.5 - 0.3 * x * y], axis=-1)
+    normalize_in_place(base)
+    jittered, pil_jittered = [], []
+    for _ in range(300):
+        # noise (applied first in some draws) leaves values outside 0 to 1.
+        tile = (base + rng.normal(0, 0.09, base.shape)).astype(np.float32)
+        pil_jittered.append(pil_color_jit_transform(tile.copy(), None)[0])
+        jittered.append(augmentor.color_jit_transform(tile, None)[0])
+    means, stds, saturated = get_jitter_stats(jittered)
+    pil_means, pil_stds, pil_saturated = get_jitter_stats(pil_jittered)
+    assert np.allclose(means, pil_means, atol=0.02)
+    assert np.allclose(stds, pil_stds, atol=0.01)
+    assert abs(saturated - pil_saturated) < 0.003
@@ -0,0 +1,52 @@
+"""
+Tests for the elastic deformation of training tiles.
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from skimage.transform import resize
+
+from root_painter_trainer import elastic
+
+
+def test_base_grid_is_identity():
+    photos = torch.rand(2, 3, 40, 50)
+    base_grid = elastic.get_base_grid(40, 50, photos.device)
+    grid = base_grid.expand(2, 40, 50, 2)
+    sampled = F.grid_sample(photos, grid, mode="bilinear", align_corners=True)
+    assert torch.allclose(sampled, photos, atol=1e-5)
+    assert elastic.get_base_grid(40, 50, photos.device) is base_grid
+
+
+def test_transform_batch_keeps_ranges_and_shapes():
+    photos = torch.rand(3, 3, 92, 92)
+    annots = (torch.rand(3, 2, 92, 92) > 0.5).float()
+    deformed, deformed_annots = elastic.transform_batch(photos, annots, 1.0)
+    assert deformed.shape == photos.shape
+    assert deformed_annots.shape == annots.shape
+    assert deformed.min() >= 0 and deformed.max() <= 1
+    assert set(torch.unique(deformed_annots).tolist()) <= {0.0, 1.0}
+    assert not torch.equal(deformed, photos)
+
+
+def test_transform_batch_with_no_tiles_chosen():
+    photos = torch.rand(2, 3, 92, 92)
+    annots = torch.zeros(2, 2, 92, 92)
+    deformed, _ = elastic.transform_batch(photos, annots, probability=0)
+    assert torch.equal(deformed, photos)
+
+
+def test_zoom_linear_matches_skimage_resize():
+    field = np.random.uniform(-1, 1, size=(11, 13)).astype(np.float32)
+    zoomed = elastic.zoom_linear(field, (88, 104))
+    expected = resize(field, (88, 104), order=1, mode="edge", anti_aliasing=False)
+    assert zoomed.shape == (88, 104)
+    assert np.allclose(zoomed, expected, atol=1e-5)
+
+
+def test_elastic_map_pool_reuses_maps():
+    pool = elastic.ElasticMapPool((40, 40), size=2)
+    maps = [pool.get() for _ in range(10)]
+    assert all(m.shape == (2, 160, 160) for m in maps)
+    assert len(pool.maps) == 2
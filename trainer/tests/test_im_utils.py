@@ -0,0 +1,100 @@
+"""
+Tests for the image utilities used when segmenting.
+"""
+
+import numpy as np
+import tifffile
+from PIL import Image
+from skimage import img_as_float32
+
+from root_painter_trainer import im_utils
+
+
+def test_tiles_to_batch_matches_per_tile_normalization():
+    image = np.random.randint(0, 255, size=(700, 900, 3), dtype=np.uint8)
+    image[:572, :572] = 7  # a constant tile is left as it is.
+    tiles, _ = im_utils.get_tiles(
+        image, in_tile_shape=(572, 572, 3), out_tile_shape=(500, 500)
+    )
+    batch = im_utils.tiles_to_batch(tiles)
+    assert batch.dtype == np.float32
+    assert batch.shape == (len(tiles), 3, 572, 572)
+    for tile, batch_tile in zip(tiles, batch):
+        expected = im_utils.normalize_tile(img_as_float32(tile))
+        expected = np.moveaxis(expected, -1, 0)
+        assert np.allclose(batch_tile, expected, atol=1e-6)
+
+
+def test_tiles_to_batch_reuses_preallocated_batch():
+    tiles = [np.random.randint(0, 255, size=(8, 8, 3), dtype=np.uint8)] * 3
+    out = np.empty((4, 3, 8, 8), dtype=np.float32)
+    batch = im_utils.tiles_to_batch(tiles, out)
+    assert len(batch) == 3
+    assert np.shares_memory(batch, out)
+
+
+def test_reconstruct_from_tiles_round_trip():
+    image = np.random.random((700, 900)).astype(np.float32)
+    tiles, coords = im_utils.get_tiles(
+        image[:, :, np.newaxis],
+        in_tile_shape=(572, 572, 1),
+        out_tile_shape=(500, 500),
+    )
+    out_tiles = [t[36:-36, 36:-36, 0] for t in tiles]
+    reconstructed = im_utils.reconstruct_from_tiles(out_tiles, coords, image.shape)
+    assert reconstructed.dtype == np.float32
+    assert np.array_equal(reconstructed, image)
+
+
+def test_band_reader_reads_rows_of_striped_tiff(tmp_path):
+    image = np.random.randint(0, 255, size=(1000, 300, 3), dtype=np.uint8)
+    path = str(tmp_path / "im.tif")
+    Image.fromarray(image).save(path)
+    reader = im_utils.ImageBandReader(path)
+    assert reader.strips
+    assert (reader.width, reader.height) == (300, 1000)
+    assert np.array_equal(reader.read(123, 789), image[123:789])
+    reader.close()
+
+
+def test_band_reader_decodes_only_strips_and_tiles_of_band(tmp_path):
+    image = np.random.randint(0, 255, size=(1000, 300, 3), dtype=np.uint8)
+    lzw_path = str(tmp_path / "lzw.tif")
+    Image.fromarray(image).save(lzw_path, compression="tiff_lzw")
+    tiled_path = str(tmp_path / "tiled.tif")
+    tifffile.imwrite(tiled_path, image, tile=(64, 64), compression="zlib")
+    for path in [lzw_path, tiled_path]:
+        reader = im_utils.ImageBandReader(path)
+        assert reader.strips and reader.array is None
+        assert np.array_equal(reader.read(123, 789), image[123:789])
+        assert np.array_equal(reader.read(789, 1000), image[789:])
+        assert len(reader.segments) < len(reader.tiff.pages[0].dataoffsets)
+        reader.close()
+
+
+def test_band_reader_reads_rows_of_grey_tiff_as_rgb(tmp_path):
+    image = np.random.randint(0, 255, size=(300, 200), dtype=np.uint8)
+    path = str(tmp_path / "grey.tif")
+    tifffile.imwrite(path, image, rowsperstrip=16, compression="zlib")
+    reader = im_utils.ImageBandReader(path)
+    assert reader.strips
+    assert np.array_equal(reader.read(10, 50), np.stack([image[10:50]] * 3, axis=2))
+    reader.close()
+
+
+def test_band_reader_reads_rows_of_png(tmp_path):
+    image = np.random.randint(0, 255, size=(200, 300, 3), dtype=np.uint8)
+    path = str(tmp_path / "im.png")
+    Image.fromarray(image).save(path)
+    reader = im_utils.ImageBandReader(path)
+    assert np.array_equal(reader.read(50, 150), image[50:150])
+    reader.close()
+
+
+def test_png_row_writer(tmp_path):
+    image = np.random.randint(0, 255, size=(100, 70, 4), dtype=np.uint8)
+    path = str(tmp_path / "out.png")
+    with im_utils.PNGRowWriter(path, 70, 100, 4) as writer:
+        writer.write_rows(image[:30])
+        writer.write_rows(image[30:])
+    assert np.array_equal(np.array(Image.open(path)), image)
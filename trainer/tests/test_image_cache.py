@@ -0,0 +1,103 @@
+"""
+Tests for the cache of decoded training images and annotations.
+"""
+
+import os
+
+import numpy as np
+from skimage.io import imsave
+
+from root_painter_trainer import im_utils
+from root_painter_trainer.image_cache import (
+    TrainImageCache,
+    get_valid_tile_offsets,
+    sample_tile_offset,
+)
+
+
+def make_project(tmp_path, fname="im.png"):
+    dataset_dir = tmp_path / "dataset"
+    annot_dir = tmp_path / "annot"
+    dataset_dir.mkdir()
+    annot_dir.mkdir()
+    image = np.random.randint(0, 255, size=(60, 80, 3), dtype=np.uint8)
+    imsave(str(dataset_dir / fname), image, check_contrast=False)
+    annot = np.zeros((60, 80, 4), dtype=np.uint8)
+    annot[10:20, 10:20, 0] = 255
+    annot[:, :, 3] = 255
+    imsave(str(annot_dir / fname), annot, check_contrast=False)
+    return str(dataset_dir), str(annot_dir), image, annot
+
+
+def test_cached_image_and_annot_are_padded(tmp_path):
+    dataset_dir, annot_dir, image, annot = make_project(tmp_path)
+    cache = TrainImageCache(str(tmp_path / "cache"))
+    cached_im, cached_annot, _ = cache.get(dataset_dir, annot_dir, "im.png", 5, 8)
+    assert np.array_equal(cached_im, im_utils.pad(image, 5))
+    assert np.array_equal(cached_annot, im_utils.pad(annot[:, :, :2] > 0, 5))
+    # second time is read from the cache
+    cached_im, _, _ = cache.get(dataset_dir, annot_dir, "im.png", 5, 8)
+    assert isinstance(cached_im, np.memmap)
+
+
+def test_updated_annotation_replaces_cache_entry(tmp_path):
+    dataset_dir, annot_dir, _, _ = make_project(tmp_path)
+    cache_dir = tmp_path / "cache"
+    cache = TrainImageCache(str(cache_dir))
+    cache.get(dataset_dir, annot_dir, "im.png", 5, 8)
+    annot_path = os.path.join(annot_dir, "im.png")
+    mtime = os.path.getmtime(annot_path)
+    os.utime(annot_path, (mtime + 10, mtime + 10))
+    cache.get(dataset_dir, annot_dir, "im.png", 5, 8)
+    assert len(os.listdir(cache_dir)) == 5  # only the files for one version
+
+
+def test_cache_evicts_to_fit_budget(tmp_path):
+    dataset_dir, annot_dir, _, _ = make_project(tmp_path)
+    cache_dir = tmp_path / "cache"
+    cache = TrainImageCache(str(cache_dir), max_bytes=0)
+    cache.get(dataset_dir, annot_dir, "im.png", 5, 8)
+    assert not os.listdir(cache_dir)
+
+
+def test_valid_tile_offsets_match_tile_sums():
+    annot = np.zeros((40, 50, 2), dtype=bool)
+    annot[12:14, 30, 0] = True
+    annot[35, 3, 1] = True
+    in_w = 8
+    valid = get_valid_tile_offsets(annot, in_w)
+    assert valid.shape == (40 - in_w, 50 - in_w)
+    for y in range(valid.shape[0]):
+        for x in range(valid.shape[1]):
+            tile = annot[y : y + in_w, x : x + in_w]
+            assert valid[y, x] == (np.sum(tile) > 0)
+
+
+def test_sampled_tile_offsets_are_valid_and_cover_all():
+    valid = np.random.random((20, 30)) > 0.8
+    valid_counts = np.cumsum(np.sum(valid, axis=1))
+    sampled = set()
+    for _ in range(5000):
+        y, x = sample_tile_offset((valid, valid_counts))
+        assert valid[y, x]
+        sampled.add((y, x))
+    assert len(sampled) == np.sum(valid)
+
+
+def test_weighted_sampling_prefers_images_with_more_annotation(tmp_path):
+    dataset_dir, annot_dir, _, annot = make_project(tmp_path)
+    annot[:, :, 1] = 255  # all defined
+    imsave(os.path.join(annot_dir, "more.png"), annot, check_contrast=False)
+    imsave(
+        os.path.join(dataset_dir, "more.png"),
+        np.zeros((60, 80, 3), dtype=np.uint8),
+        check_contrast=False,
+    )
+    cache = TrainImageCache(str(tmp_path / "cache"))
+    for fname in ["im.png", "more.png"]:
+        cache.get(dataset_dir, annot_dir, fname, 5, 8)
+    fnames = [
+        cache.load_random(dataset_dir, annot_dir, 5, 8, weighted=True)[-1]
+        for _ in range(200)
+    ]
+    assert fnames.count("more.png") > 150
@@ -0,0 +1,37 @@
+"""
+Tests for the metrics computed during training and validation.
+"""
+
+import numpy as np
+import torch
+
+from root_painter_trainer.metrics import MetricAccumulator
+
+
+def test_accumulator_matches_per_batch_sums():
+    metrics = MetricAccumulator()
+    tp = fp = tn = fn = defined_sum = 0
+    losses = []
+    for _ in range(3):
+        predicted = torch.rand(2, 16, 16) > 0.5
+        foreground = (torch.rand(2, 16, 16) > 0.5).long()
+        defined = (torch.rand(2, 16, 16) > 0.3).float()
+        loss = torch.rand(())
+        metrics.add(predicted, foreground, defined, loss)
+        losses.append(loss.item())
+        d = defined > 0
+        tp += torch.sum(predicted[d] & (foreground[d] == 1)).item()
+        fp += torch.sum(predicted[d] & (foreground[d] == 0)).item()
+        tn += torch.sum(~predicted[d] & (foreground[d] == 0)).item()
+        fn += torch.sum(~predicted[d] & (foreground[d] == 1)).item()
+        defined_sum += torch.sum(d).item()
+    values = metrics.values()
+    assert values[:5] == (tp, fp, tn, fn, defined_sum)
+    assert np.isclose(values[5], np.mean(losses))
+    assert metrics.get_metrics(1.0)["TP"] == tp
+
+
+def test_empty_accumulator():
+    tp, fp, tn, fn, defined_sum, loss = MetricAccumulator().values()
+    assert (tp, fp, tn, fn, defined_sum) == (0, 0, 0, 0, 0)
+    assert np.isnan(loss)
@@ -0,0 +1,222 @@
+"""
+Tests for the model utilities used by the trainer for segmentation
+and validation.
+"""
+
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from root_painter_trainer import model_utils
+
+
+def test_cached_model_is_reused(tmp_path):
+    model_utils.invalidate_model_cache()
+    model_utils.create_first_model_with_random_weights(str(tmp_path))
+    model_path = model_utils.get_latest_model_paths(str(tmp_path), 1)[0]
+    first = model_utils.get_cached_model(model_path)
+    second = model_utils.get_cached_model(model_path)
+    assert first is second
+
+
+def test_cached_model_reloaded_when_checkpoint_changes(tmp_path):
+    model_utils.invalidate_model_cache()
+    model_utils.create_first_model_with_random_weights(str(tmp_path))
+    model_path = model_utils.get_latest_model_paths(str(tmp_path), 1)[0]
+    first = model_utils.get_cached_model(model_path)
+    mtime = os.path.getmtime(model_path)
+    os.utime(model_path, (mtime + 10, mtime + 10))
+    assert model_utils.get_cached_model(model_path) is not first
+
+
+def test_model_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    model_utils.invalidate_model_cache()
+    monkeypatch.setattr(model_utils, "model_cache_size", 1)
+    paths = []
+    for i in range(2):
+        model_dir = tmp_path / str(i)
+        model_dir.mkdir()
+        model_utils.create_first_model_with_random_weights(str(model_dir))
+        paths.append(model_utils.get_latest_model_paths(str(model_dir), 1)[0])
+    first = model_utils.get_cached_model(paths[0])
+    model_utils.get_cached_model(paths[1])
+    assert len(model_utils._model_cache) == 1
+    assert model_utils.get_cached_model(paths[0]) is not first
+
+
+def test_partial_segment_matches_full_segment_where_defined(tmp_path):
+    model_utils.create_first_model_with_random_weights(str(tmp_path))
+    model_path = model_utils.get_latest_model_paths(str(tmp_path), 1)[0]
+    cnn = model_utils.get_cached_model(model_path)
+    image = np.random.randint(0, 255, size=(700, 1100, 3), dtype=np.uint8)
+    defined = np.zeros(image.shape[:2], dtype=int)
+    defined[10:30, 40:80] = 1
+    defined[650:, 1050:] = 1
+    full = model_utils.unet_segment(cnn, image, 2, 572, 500, threshold=None)
+    partial = model_utils.unet_segment(
+        cnn, image, 2, 572, 500, threshold=None, defined=defined
+    )
+    assert np.array_equal(full[defined > 0], partial[defined > 0])
+    assert not np.any(partial[500:600, 500:600])
+
+
+def test_segment_images_batched_across_images_matches_single(tmp_path):
+    model_utils.create_first_model_with_random_weights(str(tmp_path))
+    model_paths = model_utils.get_latest_model_paths(str(tmp_path), 1)
+    images = [
+        np.random.randint(0, 255, size=(300 + i * 50, 400, 3), dtype=np.uint8)
+        for i in range(3)
+    ]
+    batched = model_utils.ensemble_segment_images(
+        model_paths, enumerate(images), 4, 572, 500
+    )
+    for key, predicted in batched:
+        single = model_utils.ensemble_segment(model_paths, images[key], 1, 572, 500)
+        assert predicted.shape == images[key].shape[:2]
+        assert np.mean(predicted == single) > 0.999
+
+
+def test_mixed_precision_segmentation_close_to_fp32(tmp_path, monkeypatch):
+    torch.manual_seed(0)
+    model_utils.create_first_model_with_random_weights(str(tmp_path))
+    model_path = model_utils.get_latest_model_paths(str(tmp_path), 1)[0]
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, size=(600, 650, 3), dtype=np.uint8)
+    cnn = model_utils.load_model(model_path)
+    fp32 = model_utils.unet_segment(cnn, image, 2, 572, 500, threshold=None)
+    monkeypatch.setattr(model_utils, "precision", "mixed")
+    dtype = model_utils.get_autocast_dtype()
+    if dtype is None:
+        return  # no mixed precision on this device
+    cnn = model_utils.load_model(model_path)
+    mixed = model_utils.unet_segment(cnn, image, 2, 572, 500, threshold=None)
+    assert mixed.dtype == np.float32
+    diff = np.abs(fp32 - mixed)
+    if dtype == torch.float16:
+        assert np.mean(diff) < 0.01
+        assert np.max(diff) < 0.1
+    else:
+        # bfloat16 (used on CPU) has 8 bits of precision rather than the
+        # 11 of float16, which gives a mean difference of about 0.012
+        # with the untrained network.
+        assert np.mean(diff) < 0.025
+    # the segmentations agree, apart from pixels close to the threshold.
+    clear = np.abs(fp32 - 0.5) > 0.1
+    assert np.mean((fp32 > 0.5) == (mixed > 0.5)) > 0.95
+    assert np.mean((fp32[clear] > 0.5) == (mixed[clear] > 0.5)) > 0.999
+
+
+def test_torchscript_engine_matches_eager_and_is_kept(tmp_path):
+    model_utils.create_first_model_with_random_weights(str(tmp_path))
+    model_path = model_utils.get_latest_model_paths(str(tmp_path), 1)[0]
+    engine = model_utils.get_inference_engine(model_path, 572, 2, "torchscript")
+    assert model_utils.get_inference_engine(model_path, 572, 2, "torchscript") is (
+        engine
+    )
+    eager = model_utils.get_inference_engine(model_path, 572, 2, "eager")
+    # a single tile checks the padding of the last batch.
+    batch = np.random.random((1, 3, 572, 572)).astype(np.float32)
+    probs = engine.predict(batch)
+    assert probs.shape == (1, 500, 500)
+    assert np.allclose(probs, eager.predict(batch), atol=1e-4)
+
+
+def test_onnx_engine_matches_torch(tmp_path, monkeypatch):
+    pytest.importorskip("onnxruntime")
+    monkeypatch.setattr(model_utils, "derived_model_dir", str(tmp_path / "derived"))
+    model_dir = tmp_path / "models"
+    model_dir.mkdir()
+    torch.manual_seed(0)
+    model_utils.create_first_model_with_random_weights(str(model_dir))
+    model_path = model_utils.get_latest_model_paths(str(model_dir), 1)[0]
+    batch = np.random.default_rng(0).random((2, 3, 572, 572), dtype=np.float32)
+    onnx_engine = model_utils.get_inference_engine(model_path, 572, 2, "onnx")
+    eager = model_utils.get_inference_engine(model_path, 572, 2, "eager")
+    onnx_probs = onnx_engine.predict(batch)
+    eager_probs = eager.predict(batch)
+    # GroupNorm is split into several ops in the export, which changes the
+    # rounding. Through the untrained network that is a mean difference of
+    # about 5e-4, and up to a few percent for a handful of pixels.
+    diff = np.abs(onnx_probs - eager_probs)
+    assert np.mean(diff) < 2e-3
+    assert np.max(diff) < 0.05
+    # so the segmentation is the same, apart from pixels that are
+    # close to the threshold.
+    clear = np.abs(eager_probs - 0.5) > 0.05
+    assert np.array_equal(onnx_probs[clear] > 0.5, eager_probs[clear] > 0.5)
+    # the batch size is dynamic
+    assert onnx_engine.predict(batch[:1]).shape == (1, 500, 500)
+
+
+def test_int8_engine_close_to_fp32(tmp_path, monkeypatch):
+    if torch.backends.quantized.engine == "none":
+        pytest.skip("no quantized engine")
+    monkeypatch.setattr(model_utils, "derived_model_dir", str(tmp_path / "derived"))
+    model_dir = tmp_path / "models"
+    data_dir = tmp_path / "dataset"
+    model_dir.mkdir()
+    data_dir.mkdir()
+    for i in range(2):
+        image = np.random.randint(0, 255, size=(600, 600, 3), dtype=np.uint8)
+        Image.fromarray(image).save(str(data_dir / f"{i}.png"))
+    model_utils.create_first_model_with_random_weights(str(model_dir))
+    model_path = model_utils.get_latest_model_paths(str(model_dir), 1)[0]
+    model_utils.ensure_quantized(model_path, str(data_dir), 572)
+    int8 = model_utils.get_inference_engine(model_path, 572, 2, "int8")
+    eager = model_utils.get_inference_engine(model_path, 572, 2, "eager")
+    batch = model_utils.get_calibration_batch(str(data_dir), 572, 2).numpy()
+    probs = int8.predict(batch)
+    assert probs.shape == (2, 500, 500)
+    assert np.mean(np.abs(probs - eager.predict(batch))) < 0.1
+
+
+def test_ensemble_engine_averages_flipped_tiles_and_models(tmp_path):
+    engines = []
+    for i in range(2):
+        model_dir = tmp_path / str(i)
+        model_dir.mkdir()
+        model_utils.create_first_model_with_random_weights(str(model_dir))
+        model_path = model_utils.get_latest_model_paths(str(model_dir), 1)[0]
+        engines.append(model_utils.get_inference_engine(model_path, 572, 2, "eager"))
+    batch = np.random.random((1, 3, 572, 572)).astype(np.float32)
+    flipped = np.ascontiguousarray(batch[:, :, :, ::-1])
+    expected = (
+        sum(e.predict(batch) + e.predict(flipped)[:, :, ::-1] for e in engines) / 4
+    )
+    probs = model_utils.EnsembleEngine(engines).predict(batch)
+    assert np.allclose(probs, expected, atol=1e-5)
+
+
+def test_find_batch_size_backs_off_on_out_of_memory(monkeypatch):
+    tried = []
+
+    def fake_step(_model, _optimizer, bs, _in_w, _out_w, _with_validation):
+        tried.append(bs)
+        return bs <= 5
+
+    monkeypatch.setattr(model_utils, "training_step_fits", fake_step)
+    assert model_utils.find_batch_size(572, 500, max_bs=12) == 5
+    assert tried == [1, 2, 4, 8, 6, 5]
+    assert model_utils.find_batch_size(572, 500, max_bs=3) == 3
+
+
+def test_state_dict_snapshot_is_not_changed_by_training():
+    model = model_utils.model_to_device(model_utils.UNetGNRes())
+    snapshot = model_utils.get_state_dict_snapshot(model)
+    val_model = model_utils.model_from_state_dict(snapshot)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(1)
+    for key, value in model_utils.get_state_dict_snapshot(val_model).items():
+        assert torch.equal(value, snapshot[key])
+    assert model_utils.model_from_state_dict(snapshot, val_model) is val_model
+
+
+def test_training_step_fits_with_validation():
+    model = model_utils.model_to_device(model_utils.UNetGNRes())
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    assert model_utils.training_step_fits(model, optimizer, 1, 572, 500, True)
+    assert all(p.grad is None for p in model.parameters())
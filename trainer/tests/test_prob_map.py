@@ -0,0 +1,39 @@
+"""
+Tests for the probability maps saved when segmenting.
+"""
+
+import numpy as np
+import pytest
+
+from root_painter_trainer.prob_map import (
+    prob_formats,
+    ProbMapReader,
+    ProbMapWriter,
+    save_prob_map,
+    threshold_prob_map,
+)
+
+
+@pytest.mark.parametrize("format_str", list(prob_formats))
+def test_prob_map_round_trip_in_bands(tmp_path, format_str):
+    ext, _ = prob_formats[format_str]
+    probs = np.random.random((100, 30)).astype(np.float32)
+    path = str(tmp_path / ("probs" + ext))
+    with ProbMapWriter(path, 30, 100, format_str, chunk_rows=16) as writer:
+        for top in range(0, 100, 7):
+            writer.write_rows(probs[top : top + 7])
+    with ProbMapReader(path) as reader:
+        assert (reader.height, reader.width) == (100, 30)
+        assert np.allclose(reader.read(10, 70), probs[10:70], atol=1 / 255)
+        assert np.allclose(reader.read(90, 100), probs[90:], atol=1 / 255)
+
+
+def test_threshold_prob_map(tmp_path):
+    probs = np.random.random((50, 40)).astype(np.float32)
+    path = str(tmp_path / "probs.npy")
+    save_prob_map(path, probs, "Probability float16 (.npy)")
+    # float16 rounding can move values very close to the threshold
+    close = np.abs(probs - 0.5) < 1e-3
+    seg = threshold_prob_map(path, 0.5)
+    assert np.array_equal(seg[~close], (probs > 0.5)[~close])
+    assert isinstance(np.load(path, mmap_mode="r"), np.memmap)
@@ -0,0 +1,289 @@
+"""
+Tests for the training loop, without training a model to convergence.
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from skimage.io import imread, imsave
+
+from root_painter_trainer import model_utils
+from root_painter_trainer.metrics import get_metrics
+from root_painter_trainer.trainer import Trainer
+
+
+def make_trainer(tmp_path):
+    project_dir = tmp_path / "project"
+    config = {}
+    for name in ["model_dir", "train_annot_dir", "val_annot_dir", "log_dir"]:
+        config[name] = str(project_dir / name)
+        os.makedirs(config[name])
+    config["message_dir"] = str(project_dir / "messages")
+    config["dataset_dir"] = str(tmp_path / "dataset")
+    os.makedirs(config["message_dir"])
+    os.makedirs(config["dataset_dir"])
+    for i in range(2):
+        add_image(config, f"im{i}.png")
+    trainer = Trainer(sync_dir=str(tmp_path / "sync"), device="cpu", watcher="poll")
+    trainer.train_config = config
+    trainer.msg_dir = config["message_dir"]
+    trainer.model = model_utils.create_first_model_with_random_weights(
+        config["model_dir"]
+    )
+    trainer.training = True
+    return trainer, config
+
+
+def add_image(config, fname, annot_dir="val_annot_dir", shape=(40, 40)):
+    image = np.random.randint(0, 255, size=shape + (3,), dtype=np.uint8)
+    imsave(os.path.join(config["dataset_dir"], fname), image, check_contrast=False)
+    annot = np.zeros(shape + (4,), dtype=np.uint8)
+    annot[5:10, 5:10, 0] = 255
+    annot[:, :, 3] = 255
+    imsave(os.path.join(config[annot_dir], fname), annot, check_contrast=False)
+
+
+def fake_val_metrics(monkeypatch, cur_f1=0.5, prev_f1=0.5):
+    """replace get_val_metrics, returning the models it was called with"""
+    validated = []
+
+    def get_val_metrics(cnn, **_kwargs):
+        validated.append(cnn)
+        metrics = get_metrics(1, 0, 1, 0, 2, 0.0)
+        metrics["f1"] = prev_f1 if isinstance(cnn, str) else cur_f1
+        return metrics
+
+    monkeypatch.setattr(model_utils, "get_val_metrics", get_val_metrics)
+    return validated
+
+
+def test_stop_training_applies_pending_validation(tmp_path, monkeypatch):
+    trainer, config = make_trainer(tmp_path)
+    fake_val_metrics(monkeypatch, cur_f1=0.9)
+    trainer.validation()
+    trainer.stop_training(None)
+    assert trainer.val_future is None
+    # the better model validated in the background was saved.
+    assert len(os.listdir(config["model_dir"])) == 2
+
+
+def test_stop_training_after_failed_validation(tmp_path, monkeypatch):
+    trainer, _ = make_trainer(tmp_path)
+
+    def get_val_metrics(_cnn, **_kwargs):
+        raise RuntimeError("validation failed")
+
+    monkeypatch.setattr(model_utils, "get_val_metrics", get_val_metrics)
+    trainer.validation()
+    assert trainer.execute_instruction("stop_training_1234", "{}")
+    assert not trainer.training
+    assert trainer.val_future is None
+    with open(os.path.join(trainer.sync_dir, "server_log.txt")) as log_file:
+        assert "validation failed" in log_file.read()
+
+
+def run_validation(trainer):
+    trainer.validation()
+    trainer.apply_validation_result()
+
+
+def test_previous_model_metrics_reused_until_annotation_or_model_changes(
+    tmp_path, monkeypatch
+):
+    trainer, config = make_trainer(tmp_path)
+    validated = fake_val_metrics(monkeypatch)
+
+    def prev_count():
+        return len([cnn for cnn in validated if isinstance(cnn, str)])
+
+    run_validation(trainer)
+    run_validation(trainer)
+    assert prev_count() == 1
+    # an updated validation annotation
+    annot_path = os.path.join(config["val_annot_dir"], "im0.png")
+    mtime = os.path.getmtime(annot_path)
+    os.utime(annot_path, (mtime + 10, mtime + 10))
+    run_validation(trainer)
+    assert prev_count() == 2
+    # a new checkpoint
+    prev_path = model_utils.get_latest_model_paths(config["model_dir"], 1)[0]
+    model_utils.save_if_better(config["model_dir"], trainer.model, prev_path, 1, 0)
+    run_validation(trainer)
+    run_validation(trainer)
+    assert prev_count() == 3
+
+
+def test_metrics_not_stored_if_annotations_change_during_validation(
+    tmp_path, monkeypatch
+):
+    trainer, config = make_trainer(tmp_path)
+    validated = fake_val_metrics(monkeypatch)
+    add_image_during_validation = model_utils.get_val_metrics
+
+    def get_val_metrics(cnn, **kwargs):
+        add_image(config, f"new{len(validated)}.png")
+        return add_image_during_validation(cnn, **kwargs)
+
+    monkeypatch.setattr(model_utils, "get_val_metrics", get_val_metrics)
+    run_validation(trainer)
+    assert not trainer.val_metrics_store
+
+
+def segment_dataset(trainer, config, format_str="RootPainter Default (.png)"):
+    seg_dir = os.path.join(os.path.dirname(config["model_dir"]), "segmentations")
+    os.makedirs(seg_dir, exist_ok=True)
+    trainer.segment(
+        {
+            "dataset_dir": config["dataset_dir"],
+            "seg_dir": seg_dir,
+            "model_dir": config["model_dir"],
+            "format": format_str,
+            "backend": "eager",
+        }
+    )
+    return seg_dir
+
+
+def send_segment_instruction(trainer, config, backend):
+    """segment the dataset as the client would, with paths relative to the
+    sync dir. Returns True if the instruction was executed"""
+    project_dir = os.path.dirname(config["model_dir"])
+    seg_dir = os.path.join(project_dir, "segmentations")
+    os.makedirs(seg_dir, exist_ok=True)
+    instruction = {"backend": backend}
+    for k, path in [
+        ("dataset_dir", config["dataset_dir"]),
+        ("seg_dir", seg_dir),
+        ("model_dir", config["model_dir"]),
+    ]:
+        instruction[k] = os.path.relpath(path, trainer.sync_dir)
+    executed = trainer.execute_instruction("segment_1234", json.dumps(instruction))
+    return executed, seg_dir
+
+
+def test_segment_instruction_with_backend(tmp_path):
+    trainer, config = make_trainer(tmp_path)
+    executed, seg_dir = send_segment_instruction(trainer, config, "eager")
+    assert executed
+    assert sorted(os.listdir(seg_dir)) == ["im0.png", "im1.png"]
+
+
+def test_segment_instruction_with_int8_backend(tmp_path, monkeypatch):
+    trainer, config = make_trainer(tmp_path)
+    calibrated_on = []
+    ensure_quantized = model_utils.ensure_quantized
+
+    def recording_ensure_quantized(model_path, data_dir, in_w=572):
+        calibrated_on.append(data_dir)
+        return ensure_quantized(model_path, data_dir, in_w)
+
+    monkeypatch.setattr(model_utils, "ensure_quantized", recording_ensure_quantized)
+    executed, seg_dir = send_segment_instruction(trainer, config, "int8")
+    assert executed
+    assert [os.path.realpath(d) for d in calibrated_on] == [
+        os.path.realpath(config["dataset_dir"])
+    ]
+    assert sorted(os.listdir(seg_dir)) == ["im0.png", "im1.png"]
+
+
+def test_segment_folder_of_images(tmp_path):
+    trainer, config = make_trainer(tmp_path)
+    shapes = {"im0": (40, 40), "im1": (40, 40)}
+    for i, shape in enumerate([(30, 50), (64, 20), (45, 45)]):
+        add_image(config, f"other{i}.png", shape=shape)
+        shapes[f"other{i}"] = shape
+    seg_dir = segment_dataset(trainer, config)
+    assert sorted(os.listdir(seg_dir)) == sorted(f"{n}.png" for n in shapes)
+    # each segmentation is saved for the image it was predicted from.
+    for name, shape in shapes.items():
+        seg = imread(os.path.join(seg_dir, f"{name}.png"))
+        assert seg.shape == shape + (4,)
+
+
+def test_segment_skips_existing_segmentations(tmp_path):
+    trainer, config = make_trainer(tmp_path)
+    seg_dir = os.path.join(os.path.dirname(config["model_dir"]), "segmentations")
+    os.makedirs(seg_dir)
+    existing_path = os.path.join(seg_dir, "im0.png")
+    with open(existing_path, "w") as f:
+        f.write("existing")
+    segment_dataset(trainer, config)
+    with open(existing_path) as f:
+        assert f.read() == "existing"
+    assert os.path.isfile(os.path.join(seg_dir, "im1.png"))
+
+
+def test_segment_raises_writer_exception(tmp_path, monkeypatch):
+    trainer, config = make_trainer(tmp_path)
+
+    def save_segmentation(*_args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(trainer, "save_segmentation", save_segmentation)
+    with pytest.raises(OSError, match="disk full"):
+        segment_dataset(trainer, config)
+
+
+@pytest.mark.parametrize(
+    "format_str",
+    [
+        "RootPainter Default (.png)",
+        "Numpy Compressed (.npz)",
+        "Probability uint8 (.npy)",
+    ],
+)
+def test_failed_streaming_segmentation_removes_temp_files(
+    tmp_path, monkeypatch, format_str
+):
+    trainer, config = make_trainer(tmp_path)
+    # segment every image in bands.
+    trainer.streaming_min_pixels = 0
+
+    def ensemble_segment_bands(_model_paths, read_rows, height, *_args, **_kwargs):
+        yield np.zeros((8, read_rows(0, 1).shape[1]), dtype=np.float32)
+        raise RuntimeError("segmentation failed")
+
+    monkeypatch.setattr(model_utils, "ensemble_segment_bands", ensemble_segment_bands)
+    with pytest.raises(RuntimeError, match="segmentation failed"):
+        segment_dataset(trainer, config, format_str)
+    seg_dir = os.path.join(os.path.dirname(config["model_dir"]), "segmentations")
+    assert os.listdir(seg_dir) == []
+
+
+class ResizableDataset(torch.utils.data.Dataset):
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return i
+
+
+def test_train_loader_reused_until_dataset_size_changes(tmp_path):
+    trainer, _ = make_trainer(tmp_path)
+    trainer.num_workers = 0
+    trainer.persistent_workers = True
+    trainer.bs = 4
+    trainer.train_set = ResizableDataset(612)
+    loader = trainer.get_train_loader()
+    assert trainer.get_train_loader() is loader
+    # more annotations were added so the dataset is larger.
+    trainer.train_set.size = 614
+    new_loader = trainer.get_train_loader()
+    assert new_loader is not loader
+    # 153 full batches and one of 2
+    assert len(list(new_loader)) == len(new_loader) == 154
+    assert trainer.get_train_loader() is new_loader
+
+
+def test_train_loader_created_each_epoch_without_persistent_workers(tmp_path):
+    trainer, _ = make_trainer(tmp_path)
+    trainer.num_workers = 0
+    trainer.persistent_workers = False
+    trainer.train_set = ResizableDataset(612)
+    assert trainer.get_train_loader() is not trainer.get_train_loader()
@@ -0,0 +1,32 @@
+"""
+Tests for watching the instructions folder.
+"""
+
+import sys
+import time
+
+import pytest
+
+from root_painter_trainer.watcher import InotifyWatcher, PollingWatcher
+
+
+def test_polling_watcher_reports_change_once_per_interval(tmp_path):
+    watcher = PollingWatcher(str(tmp_path), poll_interval=0.2)
+    assert watcher.changed()
+    assert not watcher.changed()
+    watcher.wait(1.0)
+    assert watcher.changed()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_inotify_watcher_reports_new_file(tmp_path):
+    watcher = InotifyWatcher(str(tmp_path), resync_interval=60)
+    assert watcher.changed()  # first check always looks at the folder
+    assert not watcher.changed()
+    (tmp_path / "segment_abc").write_text("{}")
+    start = time.time()
+    watcher.wait(5.0)
+    assert time.time() - start < 1.0
+    assert watcher.changed()
+    assert not watcher.changed()
+    watcher.close()